@@ -0,0 +1,63 @@
+"""Сравнение разбора audit_datetime: datetime.strptime против audit_datetime_key.
+
+Запуск из корня проекта:
+
+    python benchmarks/bench_audit_datetime.py [количество записей]
+"""
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("N", "5")
+
+import main  # noqa: E402
+
+def parse_datetime(dt_str):
+    """Прежний разбор даты через strptime — базовая линия для сравнения."""
+    try:
+        return datetime.strptime(dt_str, main.AUDIT_DATETIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def make_records(count, seed=1):
+    rnd = random.Random(seed)
+    records = []
+    for _ in range(count):
+        ts = rnd.randint(1_600_000_000, 1_760_000_000)
+        records.append({"audit_datetime": datetime.fromtimestamp(ts).strftime(main.AUDIT_DATETIME_FORMAT)})
+    return records
+
+
+def bench(name, func, records):
+    started = time.perf_counter()
+    result = func(records)
+    elapsed = time.perf_counter() - started
+    print(f"{name:<12} {elapsed * 1000:9.1f} мс  ({len(records) / elapsed:,.0f} записей/с)")
+    return result
+
+
+def sort_strptime(records):
+    return sorted(
+        records,
+        key=lambda x: parse_datetime(x.get("audit_datetime", "01-01-1970 00:00:00")) or datetime.min,
+        reverse=True,
+    )
+
+
+def sort_fast(records):
+    return sorted(records, key=main.audit_sort_key, reverse=True)
+
+
+def run(count):
+    print(f"Сортировка {count:,} записей аудита:")
+    baseline = bench("strptime", sort_strptime, make_records(count))
+    fast = bench("fast key", sort_fast, make_records(count))
+    assert [r["audit_datetime"] for r in baseline] == [r["audit_datetime"] for r in fast]
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,62 @@
+"""Поддельные объекты Telegram для вызова обработчиков без Bot API.
+
+Реализуют ровно то, чем пользуются обработчики main: effective_chat,
+effective_user, message.reply_text/reply_document и edit_text/delete у
+отправленных сообщений.
+"""
+import itertools
+from types import SimpleNamespace
+
+_message_ids = itertools.count(1)
+
+
+class FakeMessage:
+    def __init__(self, chat, text="", user=None, sent=None):
+        self.message_id = next(_message_ids)
+        self.chat = chat
+        self.chat_id = chat.id
+        self.text = text
+        self.from_user = user
+        self.document = None
+        self.reply_to_message = None
+        # Все сообщения и файлы, отправленные ботом в ответ
+        self.sent = sent if sent is not None else []
+
+    async def reply_text(self, text, **kwargs):
+        reply = FakeMessage(self.chat, text, sent=self.sent)
+        self.sent.append(("text", text))
+        return reply
+
+    async def reply_document(self, document, caption=None, **kwargs):
+        content = getattr(document, "input_file_content", b"") or b""
+        # Файл может быть передан потоком (read_file_handle=False)
+        size = len(content.read()) if hasattr(content, "read") else len(content)
+        self.sent.append(("document", caption, size))
+        return FakeMessage(self.chat, caption or "", sent=self.sent)
+
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+        return self
+
+    async def delete(self, **kwargs):
+        return True
+
+
+class FakeUpdate:
+    def __init__(self, chat_id, text, user_id=1):
+        self.effective_chat = SimpleNamespace(id=chat_id, type="supergroup")
+        self.effective_user = SimpleNamespace(id=user_id, username=f"user{user_id}")
+        self.message = FakeMessage(self.effective_chat, text, self.effective_user)
+        self.effective_message = self.message
+
+
+class FakeContext:
+    def __init__(self, args, bot=None):
+        self.args = list(args)
+        self.bot = bot
+
+
+def make_command(chat_id, command, args, user_id=1):
+    """Пара (update, context), как её передаёт CommandHandler для `/command args`."""
+    update = FakeUpdate(chat_id, " ".join([f"/{command}", *args]), user_id)
+    return update, FakeContext(args)
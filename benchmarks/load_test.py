@@ -0,0 +1,176 @@
+"""Нагрузочный тест бота на локальной заглушке SAS и поддельном Telegram.
+
+Запуск из корня проекта:
+
+    python benchmarks/load_test.py --concurrency 1,10,50 --requests 200
+
+Для каждого уровня параллельности прогоняет заданное число команд
+(по кругу из --commands) через обработчики main и печатает команды/сек,
+перцентили задержки, число ошибок и пиковый RSS процесса.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import socket
+import stat
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_SSH = """#!{python}
+import os, sys, time
+time.sleep(float(os.environ.get("FAKE_SSH_DELAY", "0.05")))
+login = sys.argv[-1]
+for i in range(int(os.environ.get("FAKE_SSH_LINES", "200"))):
+    sys.stdout.write(f"{{i:06d}} {{login}} auth ok from 10.0.0.{{i % 250}}\\n")
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def prepare_env(args, workdir):
+    port = free_port()
+    fake_ssh = os.path.join(workdir, "ssh")
+    with open(fake_ssh, "w") as f:
+        f.write(FAKE_SSH.format(python=sys.executable))
+    os.chmod(fake_ssh, os.stat(fake_ssh).st_mode | stat.S_IEXEC)
+    fake_key = os.path.join(workdir, "id_ed25519")
+    open(fake_key, "w").close()
+    cache_ttl = str(args.cache_ttl)
+    os.environ.update({
+        "BASE_URL": f"http://127.0.0.1:{port}",
+        "N": os.environ.get("N", "5"),
+        "ORG_NAME": "bench",
+        "SSH_COMMAND": fake_ssh,
+        "SSH_KEY_PATH": fake_key,
+        "SSH_MULTIPLEX": "0",
+        "FAKE_SSH_LINES": str(args.ssh_lines),
+        "FAKE_SSH_DELAY": str(args.ssh_delay),
+        "CACHE_TTL_TOKENS": cache_ttl,
+        "CACHE_TTL_ENROLLMENTS": cache_ttl,
+        "CACHE_TTL_AUDIT": cache_ttl,
+        "AUDIT_PAGE_SIZE": str(args.page_size),
+        # Поддельный Telegram не ограничивает частоту отправки
+        "TELEGRAM_GLOBAL_RATE": "1000000",
+        "TELEGRAM_CHAT_RATE": "1000000",
+        "TELEGRAM_CHAT_BURST": "1000000",
+    })
+    return port
+
+
+async def run_level(main, fake_telegram, commands, concurrency, total, logins):
+    handlers = {
+        "tokens": (main.tokens_handler, lambda login: [login]),
+        "audit": (main.audit_handler, lambda login: [login, "500", "csv.gz"]),
+        "enrollments": (main.enrollments_handler, lambda login: [login]),
+        "sshlogs": (main.ssh_logs_handler, lambda login: [login]),
+    }
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait((commands[i % len(commands)], logins[i % len(logins)], i))
+    latencies = {command: [] for command in commands}
+    errors = {command: 0 for command in commands}
+
+    async def worker():
+        while not queue.empty():
+            command, login, i = queue.get_nowait()
+            handler, make_args = handlers[command]
+            update, context = fake_telegram.make_command(main.ALLOWED_CHAT_ID, command, make_args(login), user_id=i % 20)
+            started = time.perf_counter()
+            try:
+                await handler(update, context)
+            except Exception:
+                errors[command] += 1
+            latencies[command].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    await main.outbox.drain()
+    elapsed = time.perf_counter() - started
+    return elapsed, latencies, errors
+
+
+def report(concurrency, total, elapsed, latencies, errors):
+    print(f"\nПараллельность {concurrency}: {total} команд за {elapsed:.2f} с — {total / elapsed:.1f} команд/с, "
+          f"пиковый RSS {peak_rss_mb():.1f} МБ")
+    print(f"{'команда':<12} {'n':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'ошибки':>7}")
+    for command, samples in latencies.items():
+        print(f"{command:<12} {len(samples):>6} {percentile(samples, 0.5) * 1000:>9.1f} "
+              f"{percentile(samples, 0.95) * 1000:>9.1f} {percentile(samples, 0.99) * 1000:>9.1f} {errors[command]:>7}")
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="bot_bench_")
+    port = prepare_env(args, workdir)
+
+    import main
+    import fake_telegram
+    from mock_sas import MockSas
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    mock = MockSas(
+        latency=args.latency_ms / 1000,
+        jitter=args.jitter_ms / 1000,
+        error_rate=args.error_rate,
+        audit_records=args.audit_records,
+    )
+    server = await mock.start("127.0.0.1", port)
+    commands = args.commands.split(",")
+    logins = [f"user{i:03d}" for i in range(args.logins)]
+    try:
+        for concurrency in (int(c) for c in args.concurrency.split(",")):
+            elapsed, latencies, errors = await run_level(main, fake_telegram, commands, concurrency, args.requests, logins)
+            report(concurrency, args.requests, elapsed, latencies, errors)
+        print("\nЗапросов к заглушке SAS:", mock.requests)
+        print("\nМетрики бота:\n" + main.metrics.render_text())
+    finally:
+        server.close()
+        await server.wait_closed()
+        await main.sas_client.aclose()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,10,50", help="уровни параллельности через запятую")
+    parser.add_argument("--requests", type=int, default=200, help="команд на каждый уровень")
+    parser.add_argument("--commands", default="tokens,audit,enrollments,sshlogs", help="команды через запятую")
+    parser.add_argument("--logins", type=int, default=50, help="сколько разных логинов использовать")
+    parser.add_argument("--latency-ms", type=float, default=50, help="задержка ответа заглушки SAS")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="разброс задержки заглушки SAS")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов HTTP 500")
+    parser.add_argument("--audit-records", type=int, default=1000, help="записей аудита на пользователя")
+    parser.add_argument("--page-size", type=int, default=200, help="AUDIT_PAGE_SIZE")
+    parser.add_argument("--cache-ttl", type=float, default=0, help="TTL кеша ответов SAS (0 — без кеша)")
+    parser.add_argument("--ssh-lines", type=int, default=200, help="строк вывода поддельного ssh")
+    parser.add_argument("--ssh-delay", type=float, default=0.05, help="задержка поддельного ssh, сек")
+    parser.add_argument("--verbose", action="store_true", help="не приглушать логи бота")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
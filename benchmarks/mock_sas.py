@@ -0,0 +1,95 @@
+"""Локальная заглушка API SAS для нагрузочных тестов.
+
+Отвечает на /sdk/login, /sdk/users/user-tokens, /sdk/audit/audit и
+/sdk/users/enrollments с настраиваемой задержкой, размером истории аудита
+и долей ошибок. Сервер поднимается на main.serve_http, поэтому модуль main
+должен быть импортирован заранее (см. load_test.py).
+"""
+import asyncio
+import base64
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import main
+
+
+def make_jwt(ttl):
+    def part(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+    return ".".join([part({"alg": "none"}), part({"exp": int(time.time() + ttl)}), "sig"])
+
+
+class MockSas:
+    def __init__(self, latency=0.05, jitter=0.0, error_rate=0.0, audit_records=1000, tokens_per_user=3,
+                 token_ttl=600, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.audit_records = audit_records
+        self.tokens_per_user = tokens_per_user
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.requests = {}
+        self._histories = {}
+
+    def history(self, login):
+        """Синтетическая история аудита пользователя, от новых записей к старым."""
+        records = self._histories.get(login)
+        if records is None:
+            now = datetime(2025, 1, 1)
+            records = [
+                {
+                    "audit_login": login,
+                    "audit_datetime": (now - timedelta(minutes=7 * i)).strftime(main.AUDIT_DATETIME_FORMAT),
+                    "audit_ip_address": f"10.0.{i % 7}.{i % 250}",
+                    "audit_agent": "Mozilla/5.0" if i % 3 else "SAS Agent",
+                    "audit_result": "Success" if i % 5 else "Failure",
+                    "audit_serialnumber": f"SN{i % 4:04d}",
+                    "audit_comments": "",
+                }
+                for i in range(self.audit_records)
+            ]
+            self._histories[login] = records
+        return records
+
+    async def handle(self, method, path, headers, body):
+        path = path.split("?", 1)[0]
+        self.requests[path] = self.requests.get(path, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if self.random.random() < self.error_rate:
+            return 500, "text/plain", b"mock failure"
+        data = json.loads(body or b"{}")
+        if path == "/sdk/login":
+            result = {"Result": 0, "Token": make_jwt(self.token_ttl)}
+        elif path == "/sdk/users/user-tokens":
+            login = data.get("user_login", "")
+            result = {"Result": 0, "Data": [
+                {"token_id": f"{login}-{i}", "token_type": "OTP", "token_activation": i % 2 == 0}
+                for i in range(self.tokens_per_user)
+            ]}
+        elif path == "/sdk/audit/audit":
+            page_number = int(data.get("page_number", 1))
+            page_size = int(data.get("page_size", 200))
+            records = self.history(data.get("user_login", "").lower())
+            start_key = main.audit_datetime_key(data.get("start_date", ""))
+            if start_key:
+                records = [r for r in records if main.audit_datetime_key(r["audit_datetime"]) >= start_key]
+            start = (page_number - 1) * page_size
+            result = {"Result": 0, "Data": records[start:start + page_size]}
+        elif path == "/sdk/users/enrollments":
+            login = data.get("user_login", "")
+            if login != login.lower():
+                result = {"Result": 1, "Details": "User not found"}
+            else:
+                result = {"Result": 0, "Data": [
+                    {"enrollment_id": f"{login}-e1", "enrollment_stop_date": "31-12-2025",
+                     "enrollment_url": f"https://sas.example/enroll/{login}"}
+                ]}
+        else:
+            return 404, "text/plain", b"not found"
+        return 200, "application/json", json.dumps(result).encode()
+
+    async def start(self, host, port):
+        return await main.serve_http(host, port, self.handle)
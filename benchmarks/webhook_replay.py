@@ -0,0 +1,108 @@
+"""Отправка записанных обновлений Telegram на webhook бота.
+
+Бот запускается отдельно в режиме webhook (BOT_MODE=webhook), затем:
+
+    python benchmarks/webhook_replay.py updates.jsonl --url http://127.0.0.1:8080/telegram --secret "$WEBHOOK_SECRET"
+    python benchmarks/webhook_replay.py --command "/tokens ivanova" --count 100 --concurrency 10 --secret "$WEBHOOK_SECRET"
+
+Файл — по одному JSON-обновлению Telegram (как в getUpdates или логах
+webhook) на строку. Без файла обновления собираются из --command. Скрипт
+печатает коды ответов и перцентили времени ответа webhook; --bad-secret
+проверяет, что запросы с неверным секретом отклоняются.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+from load_test import percentile
+
+
+def command_update(update_id, chat_id, text, user_id=1):
+    """Обновление с командой в том виде, в каком его присылает Telegram."""
+    command = text.split()[0]
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "replay"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "replay"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def load_updates(args):
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = [command_update(0, args.chat_id, args.command)]
+    # update_id должны быть уникальными, иначе повторы выглядят как дубликаты
+    ids = itertools.count(args.first_update_id)
+    result = []
+    for update in itertools.islice(itertools.cycle(updates), args.count or len(updates)):
+        update = dict(update, update_id=next(ids))
+        if "message" in update:
+            update["message"] = dict(update["message"], date=int(time.time()))
+        result.append(update)
+    return result
+
+
+async def replay(args):
+    updates = load_updates(args)
+    secret = "wrong-" + args.secret if args.bad_secret else args.secret
+    statuses = Counter()
+    latencies = []
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+
+    async with httpx.AsyncClient(timeout=args.timeout) as client:
+        async def worker():
+            while not queue.empty():
+                update = queue.get_nowait()
+                started = time.perf_counter()
+                try:
+                    resp = await client.post(args.url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret})
+                    statuses[resp.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    print(f"Отправлено {len(updates)} обновлений за {elapsed:.2f} с — {len(updates) / elapsed:.1f} в секунду")
+    print("Ответы:", dict(statuses))
+    print(f"Время ответа, мс: p50 {percentile(latencies, 0.5) * 1000:.1f}, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.1f}, p99 {percentile(latencies, 0.99) * 1000:.1f}")
+    expected = 403 if args.bad_secret else 200
+    return statuses[expected] == len(updates)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", help="JSONL с записанными обновлениями")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/telegram", help="адрес webhook бота")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET бота")
+    parser.add_argument("--bad-secret", action="store_true", help="отправлять неверный секрет (ожидается 403)")
+    parser.add_argument("--command", default="/getchatid", help="команда, если файл не указан")
+    parser.add_argument("--chat-id", type=int, default=-1002321217341, help="чат для --command")
+    parser.add_argument("--count", type=int, default=0, help="сколько обновлений отправить (по кругу из файла)")
+    parser.add_argument("--first-update-id", type=int, default=1, help="update_id первого обновления")
+    parser.add_argument("--concurrency", type=int, default=1, help="одновременных запросов")
+    parser.add_argument("--timeout", type=float, default=10, help="таймаут запроса, сек")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(replay(parse_args())) else 1)
@@ -1,19 +1,37 @@
+import base64
+import codecs
+import contextlib
+import contextvars
+import functools
+import heapq
+import hmac
 import logging
+import math
 import os
+import random
+import re
 import shlex
+import signal
+import sqlite3
+import time
+from collections import Counter, OrderedDict, deque
 
-import requests
+import httpx
 import json
 import asyncio
+import csv
+import gzip
+import html
 import io
-from datetime import datetime
+import tempfile
+from datetime import datetime, timedelta
 from telegram import Update, InputFile
 from telegram.constants import ParseMode
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-import nest_asyncio
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
-nest_asyncio.apply()
 load_dotenv()
 
 BASE_URL = os.getenv("BASE_URL")
@@ -23,18 +41,974 @@ ORG_NAME = os.getenv("ORG_NAME")
 N = int(os.getenv("N"))
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ALLOWED_CHAT_ID = -1002321217341
+# Время жизни JWT (сек), если в токене нет claim'а exp
+SAS_TOKEN_TTL = int(os.getenv("SAS_TOKEN_TTL", "300"))
+# За сколько секунд до истечения токен обновляется заранее
+SAS_TOKEN_REFRESH_MARGIN = int(os.getenv("SAS_TOKEN_REFRESH_MARGIN", "30"))
+# HTTP-коды, при которых SAS считает токен недействительным
+SAS_AUTH_FAILURE_CODES = (401, 403)
+# Максимум одновременных соединений к BASE_URL (общий пул с keep-alive)
+SAS_MAX_CONNECTIONS = int(os.getenv("SAS_MAX_CONNECTIONS", "10"))
+# Сколько из них могут одновременно занимать тяжёлые команды и /watch —
+# остальные соединения всегда свободны для лёгких команд
+SAS_HEAVY_CONNECTIONS = int(os.getenv("SAS_HEAVY_CONNECTIONS", str(max(1, SAS_MAX_CONNECTIONS * 3 // 4))))
+SAS_KEEPALIVE_EXPIRY = float(os.getenv("SAS_KEEPALIVE_EXPIRY", "30"))
+# Сколько ждать свободного соединения из пула (сек)
+SAS_POOL_TIMEOUT = float(os.getenv("SAS_POOL_TIMEOUT", "30"))
+# Таймауты запросов (сек) по эндпоинтам SAS — верхняя граница адаптивного таймаута
+SAS_DEFAULT_TIMEOUT = 10.0
+SAS_TIMEOUTS = {
+    "/sdk/login": float(os.getenv("SAS_TIMEOUT_LOGIN", "10")),
+    "/sdk/users/user-tokens": float(os.getenv("SAS_TIMEOUT_TOKENS", "10")),
+    "/sdk/audit/audit": float(os.getenv("SAS_TIMEOUT_AUDIT", "20")),
+    "/sdk/users/enrollments": float(os.getenv("SAS_TIMEOUT_ENROLLMENTS", "10")),
+}
+# Адаптивный таймаут: p99 недавних задержек эндпоинта × множитель, но не меньше
+# минимума; сколько последних задержек учитывать и с какого числа замеров
+# таймаут становится адаптивным
+SAS_TIMEOUT_MIN = float(os.getenv("SAS_TIMEOUT_MIN", "2"))
+SAS_TIMEOUT_FACTOR = float(os.getenv("SAS_TIMEOUT_FACTOR", "3"))
+SAS_LATENCY_WINDOW = 200
+SAS_LATENCY_MIN_SAMPLES = 20
+# Повторы сетевых сбоев и ответов 5xx: число повторов, база экспоненциальной
+# задержки с джиттером (сек) и бюджет — доля повторов от числа запросов
+SAS_RETRY_ATTEMPTS = int(os.getenv("SAS_RETRY_ATTEMPTS", "2"))
+SAS_RETRY_BACKOFF = float(os.getenv("SAS_RETRY_BACKOFF", "0.2"))
+SAS_RETRY_BUDGET = float(os.getenv("SAS_RETRY_BUDGET", "0.1"))
+# Circuit breaker: после скольких сбоев подряд перестать обращаться к SAS,
+# на сколько секунд и сколько пробных запросов пропустить после паузы
+SAS_BREAKER_FAILURES = int(os.getenv("SAS_BREAKER_FAILURES", "5"))
+SAS_BREAKER_RESET = float(os.getenv("SAS_BREAKER_RESET", "30"))
+SAS_BREAKER_PROBES = int(os.getenv("SAS_BREAKER_PROBES", "2"))
+# Постраничная выгрузка аудита: размер страницы, число параллельных страниц,
+# предел страниц на запрос и максимальное количество записей в /audit
+AUDIT_PAGE_SIZE = int(os.getenv("AUDIT_PAGE_SIZE", "200"))
+AUDIT_PAGE_FANOUT = int(os.getenv("AUDIT_PAGE_FANOUT", "4"))
+AUDIT_MAX_PAGES = int(os.getenv("AUDIT_MAX_PAGES", "100"))
+AUDIT_MAX_COUNT = int(os.getenv("AUDIT_MAX_COUNT", "1000"))
+# Кеш ответов SAS: время жизни записей по эндпоинтам (сек, 0 — не кешировать) и размер
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "512"))
+CACHE_TTLS = {
+    "/sdk/users/user-tokens": float(os.getenv("CACHE_TTL_TOKENS", "30")),
+    "/sdk/users/enrollments": float(os.getenv("CACHE_TTL_ENROLLMENTS", "30")),
+    "/sdk/audit/audit": float(os.getenv("CACHE_TTL_AUDIT", "15")),
+}
+# Сколько секунд не запрашивать вариант логина, который SAS отклонил
+LOGIN_VARIANT_NEGATIVE_TTL = int(os.getenv("LOGIN_VARIANT_NEGATIVE_TTL", "3600"))
+# Сколько логинов и отклонённых вариантов помнить
+LOGIN_VARIANT_MAX_SIZE = 10000
+# Локальный индекс аудита (SQLite на примонтированном томе) и как часто
+# догружать в него новые записи из SAS (сек)
+AUDIT_DB_PATH = os.getenv("AUDIT_DB_PATH", "/app/data/audit.db")
+AUDIT_SYNC_INTERVAL = float(os.getenv("AUDIT_SYNC_INTERVAL", "60"))
+# Наблюдение /watch: базовый интервал опроса SAS (сек), до какого интервала
+# реже опрашивать логины без новой активности, сколько логинов опрашивать
+# параллельно и сколько событий показывать в одном уведомлении. При
+# нескольких экземплярах бота фоновый опрос включают только на одном
+WATCH_ENABLED = os.getenv("WATCH_ENABLED", "1") == "1"
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL", "60"))
+WATCH_MAX_INTERVAL = float(os.getenv("WATCH_MAX_INTERVAL", "600"))
+WATCH_CONCURRENCY = int(os.getenv("WATCH_CONCURRENCY", "4"))
+WATCH_ALERT_MAX_LINES = 20
+# /auditstats: период по умолчанию, сколько значений показывать в топах IP и
+# агентов, сколько счётчиков держать для их приближённого подсчёта и до
+# какого периода (дней) ряд строится по часам, а не по дням
+AUDITSTATS_DEFAULT_PERIOD = os.getenv("AUDITSTATS_DEFAULT_PERIOD", "7d")
+AUDITSTATS_TOP_K = int(os.getenv("AUDITSTATS_TOP_K", "5"))
+AUDITSTATS_COUNTERS = int(os.getenv("AUDITSTATS_COUNTERS", "100"))
+AUDITSTATS_HOURLY_DAYS = 7
+# Сколько байт выгрузки держать в памяти, прежде чем сбросить её во временный файл
+EXPORT_SPOOL_MAX_SIZE = int(os.getenv("EXPORT_SPOOL_MAX_SIZE", str(1024 * 1024)))
+# SSH к серверу логов (/sshlogs)
+SSH_COMMAND = os.getenv("SSH_COMMAND", "ssh")
+SSH_KEY_PATH = os.getenv("SSH_KEY_PATH", "/app/ssh/id_ed25519")
+SSH_KNOWN_HOSTS = os.getenv("SSH_KNOWN_HOSTS", "/app/ssh/known_hosts")
+SSH_HOST = os.getenv("SSH_HOST", "10.4.96.65")
+SSH_USER = os.getenv("SSH_USER", "tgbot")
+SSH_TIMEOUT = float(os.getenv("SSH_TIMEOUT", "30"))
+# Постоянное мультиплексированное соединение (ControlMaster): 0 — отключить
+SSH_MULTIPLEX = os.getenv("SSH_MULTIPLEX", "1") == "1"
+SSH_CONTROL_PATH = os.getenv("SSH_CONTROL_PATH", "/tmp/bot_audit_ssh.sock")
+# Сколько сессий одновременно открывать поверх одного соединения (MaxSessions на сервере — 10)
+SSH_MAX_SESSIONS = int(os.getenv("SSH_MAX_SESSIONS", "8"))
+# Вывод /sshlogs: предел в байтах, порог отправки сообщением (символов),
+# размер чанка чтения и интервал обновления сообщения о прогрессе (сек)
+SSH_OUTPUT_MAX_BYTES = int(os.getenv("SSH_OUTPUT_MAX_BYTES", str(50 * 1024 * 1024)))
+SSH_INLINE_MAX_CHARS = 4000
+SSH_READ_CHUNK = 64 * 1024
+SSH_PROGRESS_INTERVAL = float(os.getenv("SSH_PROGRESS_INTERVAL", "2"))
+# Пакетные запросы (несколько логинов или файл со списком): параллельность,
+# предел логинов, размер загружаемого файла и интервал обновления прогресса
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_LOGINS = int(os.getenv("BATCH_MAX_LOGINS", "500"))
+BATCH_MAX_FILE_SIZE = 1024 * 1024
+BATCH_PROGRESS_INTERVAL = float(os.getenv("BATCH_PROGRESS_INTERVAL", "2"))
+# Исходящие сообщения Telegram: сколько частей допустимо в одном ответе
+# (больше — ответ уходит файлом), общий лимит бота (сообщений/сек), лимит
+# на чат (сообщений/мин) с допустимым всплеском и число повторов после RetryAfter
+TELEGRAM_MESSAGE_LIMIT = 4096
+TELEGRAM_MAX_PARTS = int(os.getenv("TELEGRAM_MAX_PARTS", "4"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "20"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+# Планировщик команд: размеры пулов тяжёлых (выгрузки, SSH, пакеты) и лёгких
+# команд, сколько команд каждого вида один пользователь выполняет одновременно
+# и сколько команд может ждать в очереди каждого пула
+SCHEDULER_HEAVY_WORKERS = int(os.getenv("SCHEDULER_HEAVY_WORKERS", "4"))
+SCHEDULER_LIGHT_WORKERS = int(os.getenv("SCHEDULER_LIGHT_WORKERS", "16"))
+SCHEDULER_USER_HEAVY = int(os.getenv("SCHEDULER_USER_HEAVY", "1"))
+SCHEDULER_USER_LIGHT = int(os.getenv("SCHEDULER_USER_LIGHT", "4"))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+# Режим получения обновлений: polling (по умолчанию) или webhook. Для webhook —
+# публичный URL, который регистрируется в Telegram, адрес, порт и путь
+# встроенного HTTP-сервера, секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+# и сколько соединений Telegram может открыть одновременно
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# HTTP-эндпоинт метрик в формате Prometheus: порт 0 — отключён
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-def get_jwt_token():
-    url = f"{BASE_URL}/sdk/login"
-    headers = {"Content-Type": "application/json"}
+# Границы корзин гистограмм: задержки (сек) и размеры ответов (байт)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами; перцентили оцениваются интерполяцией внутри корзины."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Метрики горячих путей: задержки, ошибки и размеры ответов.
+
+    Серии различаются парой (kind, name): kind — command, sas, ssh или
+    telegram, name — команда, эндпоинт SAS или метод Bot API.
+    """
+
+    def __init__(self):
+        self.latency = {}
+        self.sizes = {}
+        self.errors = Counter()
+
+    def observe_latency(self, kind, name, seconds):
+        self.latency.setdefault((kind, name), Histogram(LATENCY_BUCKETS)).observe(seconds)
+
+    def observe_size(self, kind, name, size):
+        self.sizes.setdefault((kind, name), Histogram(SIZE_BUCKETS)).observe(size)
+
+    def error(self, kind, name, error_kind):
+        self.errors[(kind, name, error_kind)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, kind, name):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(kind, name, classify_error(e))
+            raise
+        finally:
+            self.observe_latency(kind, name, time.perf_counter() - started)
+
+    def render_text(self):
+        """Сводка для /stats."""
+        lines = ["Задержки, мс (n / p50 / p95 / p99):"]
+        for (kind, name), hist in sorted(self.latency.items()):
+            lines.append(
+                f"{kind} {name}: {hist.count} / {hist.quantile(0.5) * 1000:.0f}"
+                f" / {hist.quantile(0.95) * 1000:.0f} / {hist.quantile(0.99) * 1000:.0f}"
+            )
+        if self.errors:
+            lines.append("")
+            lines.append("Ошибки:")
+            for (kind, name, error_kind), count in sorted(self.errors.items()):
+                lines.append(f"{kind} {name} {error_kind}: {count}")
+        if self.sizes:
+            lines.append("")
+            lines.append("Размер ответов, КБ (сред. / p95):")
+            for (kind, name), hist in sorted(self.sizes.items()):
+                lines.append(f"{kind} {name}: {hist.sum / hist.count / 1024:.1f} / {hist.quantile(0.95) / 1024:.1f}")
+        return "\n".join(lines)
+
+    def render_prometheus(self, cache_stats=None):
+        """Метрики в текстовом формате Prometheus."""
+        lines = []
+
+        def histogram(metric, series):
+            lines.append(f"# TYPE {metric} histogram")
+            for (kind, name), hist in sorted(series.items()):
+                labels = f'kind="{prometheus_escape(kind)}",name="{prometheus_escape(name)}"'
+                cumulative = 0
+                for bound, bucket_count in zip(hist.buckets, hist.counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {hist.count}')
+                lines.append(f"{metric}_sum{{{labels}}} {hist.sum}")
+                lines.append(f"{metric}_count{{{labels}}} {hist.count}")
+
+        histogram("bot_latency_seconds", self.latency)
+        histogram("bot_payload_bytes", self.sizes)
+        lines.append("# TYPE bot_errors_total counter")
+        for (kind, name, error_kind), count in sorted(self.errors.items()):
+            lines.append(
+                f'bot_errors_total{{kind="{prometheus_escape(kind)}",name="{prometheus_escape(name)}",'
+                f'error="{prometheus_escape(error_kind)}"}} {count}'
+            )
+        if cache_stats:
+            lines.append("# TYPE bot_cache_requests_total counter")
+            for endpoint, counters in sorted(cache_stats.items()):
+                for result, count in counters.items():
+                    lines.append(f'bot_cache_requests_total{{endpoint="{prometheus_escape(endpoint)}",result="{result}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def classify_error(exc):
+    """Короткое название вида ошибки для метрик."""
+    if isinstance(exc, httpx.TimeoutException) or isinstance(exc, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(exc, httpx.ConnectError):
+        return "connect"
+    return type(exc).__name__
+
+
+metrics = Metrics()
+
+
+def instrumented(command, handler):
+    """Оборачивает обработчик команды замером задержки и подсчётом ошибок.
+
+    Если circuit breaker SAS разомкнут, команда сразу получает понятный ответ.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        try:
+            with metrics.timer("command", command):
+                return await handler(update, context)
+        except SasUnavailable as e:
+            outbox.reply_text(update.effective_message, f"{e}.")
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий каждый вызов Telegram Bot API."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        with metrics.timer("telegram", endpoint):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        metrics.observe_size("telegram", endpoint, len(payload))
+        if code >= 400:
+            metrics.error("telegram", endpoint, f"http_{code}")
+        return code, payload
+
+
+# Открывающая и закрывающая разметка блока кода для каждого режима разметки
+MESSAGE_CODE_BLOCKS = {
+    ParseMode.MARKDOWN: ("```\n", "\n```"),
+    ParseMode.MARKDOWN_V2: ("```\n", "\n```"),
+    ParseMode.HTML: ("<pre>", "</pre>"),
+}
+
+
+def code_block_state(line, in_code, parse_mode):
+    """Открыт ли блок кода после строки line, если до неё он был открыт (in_code)."""
+    if parse_mode == ParseMode.HTML:
+        opened, closed = line.rfind("<pre"), line.rfind("</pre>")
+        if opened != closed:
+            return opened > closed
+        return in_code
+    if parse_mode in (ParseMode.MARKDOWN, ParseMode.MARKDOWN_V2) and line.count("```") % 2:
+        return not in_code
+    return in_code
+
+
+def split_message(text, parse_mode=None, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Режет текст на части не длиннее limit символов.
+
+    Режет по границам строк, по возможности между блоками кода (если часть
+    при этом заполнена хотя бы наполовину). Если блок кода приходится
+    разрезать, он закрывается в конце части и открывается заново в начале
+    следующей, чтобы каждая часть оставалась корректной разметкой. Строки
+    длиннее части режутся принудительно.
+    """
+    if len(text) <= limit:
+        return [text]
+    opening, closing = MESSAGE_CODE_BLOCKS.get(parse_mode, ("", ""))
+    width = limit - len(opening) - len(closing)
+    parts = []
+    current = []
+    size = -1
+    # Сколько первых строк current можно отправить, не разрывая блок кода
+    safe = 0
+    in_code = False
+    for line in text.split("\n"):
+        for piece in [line[i:i + width] for i in range(0, len(line), width)] or [""]:
+            after = code_block_state(piece, in_code, parse_mode)
+            if current and size + 1 + len(piece) + (len(closing) if after else 0) > limit:
+                head = "\n".join(current[:safe])
+                if 0 < safe < len(current) and len(head) >= limit // 2:
+                    parts.append(head)
+                    current = current[safe:]
+                    size = len("\n".join(current))
+                    safe = 0
+                if size + 1 + len(piece) + (len(closing) if after else 0) > limit:
+                    parts.append("\n".join(current) + (closing if in_code else ""))
+                    current, size, safe = [], -1, 0
+                    if in_code:
+                        piece = opening + piece
+            current.append(piece)
+            size += 1 + len(piece)
+            in_code = after
+            if not in_code:
+                safe = len(current)
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
+def plain_text(text, parse_mode=None):
+    """Текст сообщения без разметки — для отправки длинного ответа файлом."""
+    if parse_mode == ParseMode.HTML:
+        return html.unescape(re.sub(r"<[^>]+>", "", text))
+    if parse_mode in (ParseMode.MARKDOWN, ParseMode.MARKDOWN_V2):
+        return "\n".join(line for line in text.split("\n") if line.strip() != "```")
+    return text
+
+
+class TokenBucket:
+    """Ведро токенов: rate отправок в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Опустошает ведро и не выдаёт токены ближайшие seconds секунд (RetryAfter)."""
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.updated:
+                    await asyncio.sleep(self.updated - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Outbox:
+    """Очередь исходящих сообщений Telegram.
+
+    У каждого чата своя очередь: отправки в чат идут строго по порядку и
+    ограничены ведром токенов чата и общим ведром бота. На RetryAfter
+    отправка повторяется после паузы, которую назвал Telegram. Обработчик
+    не ждёт доставки: reply_text возвращает future с последним отправленным
+    сообщением (None, если отправить не удалось).
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE / 60,
+                 chat_burst=TELEGRAM_CHAT_BURST, retries=TELEGRAM_SEND_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._buckets = {}
+        self._queues = {}
+        self._workers = {}
+
+    def submit(self, chat_id, send):
+        """Ставит отправку send() (корутинная функция без аргументов) в очередь чата."""
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+            self._workers[chat_id] = asyncio.create_task(self._work(chat_id, queue))
+        queue.put_nowait((send, future))
+        return future
+
+    def reply_text(self, message, text, parse_mode=None, **kwargs):
+        parts = split_message(text, parse_mode)
+        if len(parts) > TELEGRAM_MAX_PARTS:
+            logger.info("Ответ из %s частей отправляется файлом", len(parts))
+            return self.reply_document(
+                message,
+                document=InputFile(io.BytesIO(plain_text(text, parse_mode).encode("utf-8")), filename="reply.txt"),
+                caption="Ответ слишком длинный для сообщения, отправляю файлом."
+            )
+        for part in parts:
+            future = self.submit(message.chat_id, functools.partial(message.reply_text, part, parse_mode=parse_mode, **kwargs))
+        return future
+
+    def send_message(self, bot, chat_id, text, parse_mode=None):
+        """Сообщение в чат без входящего сообщения — для уведомлений."""
+        for part in split_message(text, parse_mode):
+            future = self.submit(chat_id, functools.partial(bot.send_message, chat_id, part, parse_mode=parse_mode))
+        return future
+
+    def reply_document(self, message, document, **kwargs):
+        async def send():
+            # При повторе после RetryAfter поток нужно отдать заново с начала
+            content = getattr(document, "input_file_content", None)
+            if hasattr(content, "seek"):
+                content.seek(0)
+            return await message.reply_document(document=document, **kwargs)
+        return self.submit(message.chat_id, send)
+
+    async def drain(self):
+        """Дожидается отправки всего, что уже стоит в очередях."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    async def _work(self, chat_id, queue):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        try:
+            while not queue.empty():
+                send, future = queue.get_nowait()
+                try:
+                    result = await self._deliver(chat_id, bucket, send)
+                except Exception as e:
+                    logger.error("Не удалось отправить сообщение в чат %s: %s", chat_id, e)
+                    result = None
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            del self._queues[chat_id]
+            del self._workers[chat_id]
+
+    async def _deliver(self, chat_id, bucket, send):
+        for attempt in range(self.retries + 1):
+            await bucket.acquire()
+            await self._global.acquire()
+            try:
+                return await send()
+            except RetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Telegram ограничил отправку в чат %s, пауза %s с", chat_id, e.retry_after)
+                bucket.pause(e.retry_after)
+
+
+outbox = Outbox()
+
+
+class WorkerPool:
+    """Пул планировщика: сколько команд выполняется и кто ждёт своей очереди."""
+
+    def __init__(self, name, workers, per_user, max_queue):
+        self.name = name
+        self.workers = workers
+        self.per_user = per_user
+        self.max_queue = max_queue
+        self.running = 0
+        self.running_by_user = Counter()
+        # (user_id, future, время постановки) в порядке поступления
+        self.waiting = deque()
+
+
+class CommandScheduler:
+    """Планировщик команд с отдельными пулами для тяжёлых и лёгких команд.
+
+    Команда выполняется сразу, если в её пуле есть свободное место и у
+    пользователя не исчерпан лимит одновременных команд этого вида; иначе
+    она ждёт в очереди пула, а пользователь получает ответ с позицией.
+    Очередь обходится по порядку, но команды пользователя, упёршегося в
+    свой лимит, не задерживают остальных. Лёгкие команды не конкурируют
+    с тяжёлыми, поэтому остаются быстрыми при загруженном боте.
+    """
+
+    def __init__(self):
+        self.pools = {
+            "heavy": WorkerPool("heavy", SCHEDULER_HEAVY_WORKERS, SCHEDULER_USER_HEAVY, SCHEDULER_MAX_QUEUE),
+            "light": WorkerPool("light", SCHEDULER_LIGHT_WORKERS, SCHEDULER_USER_LIGHT, SCHEDULER_MAX_QUEUE),
+        }
+
+    def wrap(self, handler, pool):
+        """Оборачивает обработчик; pool — имя пула или функция (update, context) -> имя пула."""
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            # Чужие чаты обработчик отсекает сам, места в пулах они не занимают
+            if update.effective_chat.id != ALLOWED_CHAT_ID:
+                return await handler(update, context)
+            name = pool(update, context) if callable(pool) else pool
+            user_id = update.effective_user.id if update.effective_user else update.effective_chat.id
+            if not await self.acquire(self.pools[name], user_id, update.effective_message):
+                return
+            heavy = sas_heavy.set(name == "heavy")
+            try:
+                return await handler(update, context)
+            finally:
+                sas_heavy.reset(heavy)
+                self.release(self.pools[name], user_id)
+        return wrapper
+
+    async def acquire(self, pool, user_id, message):
+        """Ждёт места в пуле; False, если очередь переполнена или команду отменили."""
+        if not pool.waiting and self._can_start(pool, user_id):
+            self._start(pool, user_id)
+            return True
+        if len(pool.waiting) >= pool.max_queue:
+            metrics.error("scheduler", pool.name, "queue_full")
+            outbox.reply_text(message, "Бот перегружен, очередь команд заполнена. Попробуйте позже.")
+            return False
+        future = asyncio.get_running_loop().create_future()
+        entry = (user_id, future, time.perf_counter())
+        pool.waiting.append(entry)
+        self._dispatch(pool)
+        if not future.done():
+            outbox.reply_text(message, f"Команда в очереди, позиция {len(pool.waiting)}. Отменить: /cancel")
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # Обработку прервали (например, при остановке бота): освобождаем очередь или место
+            if entry in pool.waiting:
+                pool.waiting.remove(entry)
+            elif not future.cancelled() and future.result():
+                self.release(pool, user_id)
+            raise
+
+    def release(self, pool, user_id):
+        pool.running -= 1
+        pool.running_by_user[user_id] -= 1
+        if not pool.running_by_user[user_id]:
+            del pool.running_by_user[user_id]
+        self._dispatch(pool)
+
+    def cancel(self, user_id):
+        """Отменяет ожидающие команды пользователя; возвращает их число."""
+        cancelled = 0
+        for pool in self.pools.values():
+            for entry in [entry for entry in pool.waiting if entry[0] == user_id]:
+                pool.waiting.remove(entry)
+                entry[1].set_result(False)
+                cancelled += 1
+        return cancelled
+
+    def stats(self):
+        return {name: (pool.running, len(pool.waiting)) for name, pool in self.pools.items()}
+
+    def _can_start(self, pool, user_id):
+        return pool.running < pool.workers and pool.running_by_user[user_id] < pool.per_user
+
+    def _start(self, pool, user_id):
+        pool.running += 1
+        pool.running_by_user[user_id] += 1
+
+    def _dispatch(self, pool):
+        for entry in list(pool.waiting):
+            if pool.running >= pool.workers:
+                break
+            user_id, future, queued_at = entry
+            if future.done():
+                pool.waiting.remove(entry)
+            elif self._can_start(pool, user_id):
+                pool.waiting.remove(entry)
+                self._start(pool, user_id)
+                metrics.observe_latency("queue", pool.name, time.perf_counter() - queued_at)
+                future.set_result(True)
+
+
+def batch_pool(update, context):
+    """Пул /tokens и /enrollments: пакет (несколько логинов или файл) — тяжёлая команда."""
+    return "heavy" if is_batch_request(update, context.args or []) else "light"
+
+
+def audit_pool(update, context):
+    """Пул /audit: пакет и выгрузка из SAS — тяжёлые, запрос с фильтрами идёт в локальный индекс и лёгкий."""
+    args = context.args or []
+    logins, count = split_audit_args(args)
+    if is_batch_request(update, logins):
+        return "heavy"
+    if any("=" in arg for arg in args):
+        return "light"
+    return "heavy" if count is not None else "light"
+
+
+scheduler = CommandScheduler()
+
+
+async def serve_http(host, port, handle, max_body=1024 * 1024):
+    """Минимальный встроенный HTTP/1.1-сервер на asyncio.
+
+    handle(method, path, headers, body) возвращает (status, content_type, body);
+    каждое соединение обслуживает один запрос. Тело больше max_body байт
+    отклоняется, не дочитываясь.
+    """
+    async def on_connection(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", "0"))
+            if length > max_body:
+                status, content_type, payload = 413, "text/plain", b"payload too large"
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), timeout=10) if length else b""
+                status, content_type, payload = await handle(method, path, headers, body)
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            status, content_type, payload = 400, "text/plain", b"bad request"
+        except Exception:
+            logger.exception("Ошибка обработки HTTP-запроса")
+            status, content_type, payload = 500, "text/plain", b"internal error"
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + payload
+        )
+        with contextlib.suppress(ConnectionError):
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(on_connection, host, port)
+
+
+HTTP_REASONS = {
+    200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+    413: "Payload Too Large", 500: "Internal Server Error",
+}
+
+
+async def handle_metrics_request(method, path, headers, body):
+    if method != "GET" or path.split("?", 1)[0] != "/metrics":
+        return 404, "text/plain", b"not found"
+    text = metrics.render_prometheus(response_cache.stats())
+    return 200, "text/plain; version=0.0.4; charset=utf-8", text.encode("utf-8")
+
+
+def webhook_handler(app):
+    """Обработчик serve_http для webhook: проверяет секрет и ставит обновление в очередь приложения.
+
+    Ответ Telegram отдаётся сразу после постановки в очередь, не дожидаясь
+    выполнения команды. GET /healthz нужен для проверок обратного прокси.
+    """
+    secret = WEBHOOK_SECRET.encode()
+
+    async def handle(method, path, headers, body):
+        path = path.split("?", 1)[0]
+        if path == "/healthz":
+            return 200, "text/plain", b"ok"
+        if path != WEBHOOK_PATH:
+            return 404, "text/plain", b"not found"
+        if method != "POST":
+            return 405, "text/plain", b"method not allowed"
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(), secret):
+            metrics.error("webhook", "update", "forbidden")
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            update = None
+        if update is None:
+            # Корректный JSON, но не обновление Telegram
+            metrics.error("webhook", "update", "bad_request")
+            return 400, "text/plain", b"bad request"
+        await app.update_queue.put(update)
+        metrics.observe_size("webhook", "update", len(body))
+        return 200, "text/plain", b"ok"
+
+    return handle
+
+
+class AdaptiveTimeouts:
+    """Таймауты по эндпоинтам из недавних задержек.
+
+    Пока замеров меньше SAS_LATENCY_MIN_SAMPLES, действует SAS_TIMEOUTS;
+    дальше — p99 последних SAS_LATENCY_WINDOW задержек × SAS_TIMEOUT_FACTOR
+    в пределах [SAS_TIMEOUT_MIN, SAS_TIMEOUTS]. Истёкший таймаут тоже
+    попадает в окно, так что при замедлении SAS таймаут растёт обратно.
+    """
+
+    def __init__(self, window=SAS_LATENCY_WINDOW, min_samples=SAS_LATENCY_MIN_SAMPLES,
+                 factor=SAS_TIMEOUT_FACTOR, floor=SAS_TIMEOUT_MIN):
+        self.window = window
+        self.min_samples = min_samples
+        self.factor = factor
+        self.floor = floor
+        self._samples = {}
+
+    def observe(self, path, seconds):
+        samples = self._samples.get(path)
+        if samples is None:
+            samples = self._samples[path] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def timeout(self, path):
+        ceiling = SAS_TIMEOUTS.get(path, SAS_DEFAULT_TIMEOUT)
+        samples = self._samples.get(path)
+        if samples is None or len(samples) < self.min_samples:
+            return ceiling
+        ordered = sorted(samples)
+        p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+        return min(ceiling, max(self.floor, p99 * self.factor))
+
+
+class RetryBudget:
+    """Бюджет повторов: каждый запрос добавляет ratio повтора, каждый повтор тратит один.
+
+    Когда SAS деградирует целиком, повторы быстро исчерпывают бюджет и не
+    умножают нагрузку на него.
+    """
+
+    def __init__(self, ratio=SAS_RETRY_BUDGET, cap=10.0):
+        self.ratio = ratio
+        self.cap = cap
+        self.balance = cap
+
+    def deposit(self):
+        self.balance = min(self.cap, self.balance + self.ratio)
+
+    def withdraw(self):
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+class CircuitBreaker:
+    """Circuit breaker: closed → open после серии сбоев → half-open → closed.
+
+    В состоянии open запросы сразу отклоняются с SasUnavailable. Через
+    reset_timeout секунд пропускается не больше probes пробных запросов
+    одновременно: probes успешных подряд закрывают автомат, любой сбой
+    снова размыкает его. Переходы пишутся в лог.
+    """
+
+    def __init__(self, name, failures=SAS_BREAKER_FAILURES, reset_timeout=SAS_BREAKER_RESET, probes=SAS_BREAKER_PROBES):
+        self.name = name
+        self.failure_threshold = failures
+        self.reset_timeout = reset_timeout
+        self.probes = probes
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker %s: %s -> %s", self.name, self.state, state)
+            self.state = state
+
+    def before_request(self):
+        """Разрешает запрос или поднимает SasUnavailable."""
+        if self.state == "open":
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                metrics.error("sas", "breaker", "rejected")
+                raise SasUnavailable(remaining)
+            self._set_state("half-open")
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+        if self.state == "half-open":
+            if self._probes_in_flight >= self.probes:
+                metrics.error("sas", "breaker", "rejected")
+                raise SasUnavailable(1)
+            self._probes_in_flight += 1
+
+    def abandon(self):
+        """Запрос завершился без результата (отмена, ошибка на нашей стороне): освобождает место пробы."""
+        if self.state == "half-open":
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+
+    def record(self, ok):
+        if self.state == "half-open":
+            self._probes_in_flight = max(0, self._probes_in_flight - 1)
+            if not ok:
+                self._open()
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.probes:
+                self.failures = 0
+                self._set_state("closed")
+        elif self.state == "closed":
+            self.failures = 0 if ok else self.failures + 1
+            if self.failures >= self.failure_threshold:
+                self._open()
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self.failures = 0
+        self._set_state("open")
+        metrics.error("sas", "breaker", "opened")
+
+
+# Запрос SAS выполняется тяжёлой задачей (пул heavy планировщика, /watch)
+sas_heavy = contextvars.ContextVar("sas_heavy", default=False)
+
+
+class SasClient:
+    """Асинхронный клиент SAS с общим пулом соединений и keep-alive.
+
+    httpx.AsyncClient создаётся лениво, уже внутри работающего event loop,
+    и ограничивает число одновременных соединений к BASE_URL. Все вызовы
+    SAS — идемпотентные GET, поэтому сетевые сбои и ответы 5xx повторяются
+    с экспоненциальной задержкой и джиттером в пределах бюджета повторов;
+    таймауты подстраиваются под недавние задержки, а circuit breaker
+    отклоняет запросы сразу, пока SAS недоступен. Запросы тяжёлых задач
+    (sas_heavy) занимают не больше heavy_connections соединений.
+    """
+
+    def __init__(self, base_url, max_connections=SAS_MAX_CONNECTIONS, keepalive_expiry=SAS_KEEPALIVE_EXPIRY,
+                 heavy_connections=SAS_HEAVY_CONNECTIONS):
+        self.base_url = base_url or ""
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = None
+        self._heavy_slots = asyncio.Semaphore(min(heavy_connections, max_connections))
+        self.timeouts = AdaptiveTimeouts()
+        self.retry_budget = RetryBudget()
+        self.breaker = CircuitBreaker("SAS")
+
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=self._limits,
+                headers={"Content-Type": "application/json"},
+                verify=False,
+            )
+        return self._client
+
+    async def get(self, path, data, token=None):
+        # SAS принимает параметры в теле GET-запроса
+        headers = {"Authorization": token} if token else None
+        content = json.dumps(data)
+        self.retry_budget.deposit()
+        slots = self._heavy_slots if sas_heavy.get() else contextlib.nullcontext()
+        attempt = 0
+        while True:
+            self.breaker.before_request()
+            seconds = self.timeouts.timeout(path)
+            recorded = False
+            try:
+                async with slots:
+                    resp = await self._request(path, content, headers, seconds)
+            except httpx.PoolTimeout:
+                # Нет свободного соединения в нашем пуле — SAS тут ни при чём
+                raise
+            except httpx.TransportError:
+                self.breaker.record(False)
+                recorded = True
+                if not self._may_retry(path, attempt):
+                    raise
+            else:
+                failed = resp.status_code >= 500
+                self.breaker.record(not failed)
+                recorded = True
+                if not failed or not self._may_retry(path, attempt):
+                    return resp
+            finally:
+                # Отмена, PoolTimeout и прочие исключения ничего не говорят о SAS,
+                # но пробный запрос half-open должен освободить своё место
+                if not recorded:
+                    self.breaker.abandon()
+            attempt += 1
+            delay = random.uniform(0, SAS_RETRY_BACKOFF * 2 ** attempt)
+            logger.warning("Повтор запроса SAS %s через %.2f с (попытка %s)", path, delay, attempt + 1)
+            await asyncio.sleep(delay)
+
+    async def _request(self, path, content, headers, seconds):
+        timeout = httpx.Timeout(seconds, pool=SAS_POOL_TIMEOUT)
+        started = time.perf_counter()
+        try:
+            with metrics.timer("sas", path):
+                resp = await self._get_client().request("GET", path, content=content, headers=headers, timeout=timeout)
+        except httpx.TimeoutException as e:
+            if not isinstance(e, httpx.PoolTimeout):
+                self.timeouts.observe(path, seconds)
+            raise
+        self.timeouts.observe(path, time.perf_counter() - started)
+        metrics.observe_size("sas", path, len(resp.content))
+        if resp.status_code != 200:
+            metrics.error("sas", path, f"http_{resp.status_code}")
+        return resp
+
+    def _may_retry(self, path, attempt):
+        if attempt >= SAS_RETRY_ATTEMPTS or self.breaker.state != "closed":
+            return False
+        if not self.retry_budget.withdraw():
+            metrics.error("sas", path, "retry_budget_exhausted")
+            return False
+        metrics.error("sas", path, "retried")
+        return True
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+sas_client = SasClient(BASE_URL)
+
+
+async def get_jwt_token():
     data = {"guid": GUID, "signature": SIGNATURE}
     try:
-        response = requests.get(url, headers=headers, data=json.dumps(data), timeout=10, verify=False)
+        response = await sas_client.get("/sdk/login", data)
         if response.status_code == 200:
             body = response.json()
             if body.get("Result") == 0:
@@ -44,70 +1018,1182 @@ def get_jwt_token():
                 logger.error("Ошибка авторизации: %s", body.get("Details", "(нет описания)"))
         else:
             logger.error("HTTP ошибка при авторизации: %s %s", response.status_code, response.text)
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error("Сетевая ошибка при авторизации: %s", str(e))
     return None
 
-def get_tokens_for_user(token, user_login, count):
-    url = f"{BASE_URL}/sdk/users/user-tokens"
-    headers = {
-        "Authorization": token,
-        "Content-Type": "application/json"
-    }
-    data = {
-        "org_name": ORG_NAME,
-        "user_login": user_login
-    }
-    try:
-        resp = requests.get(url, headers=headers, data=json.dumps(data), timeout=10, verify=False)
-        if resp.status_code == 200:
-            body = resp.json()
-            if body.get("Result") == 0:
-                tokens = body.get("Data", [])
-                return tokens[:count]
-            else:
-                logger.error("Ошибка запроса /sdk/users/user-tokens: %s", body.get("Details", "(нет описания)"))
+
+def get_jwt_expiry(token):
+    """Возвращает время истечения JWT (claim exp, unix time) или None."""
+    try:
+        payload = token.split()[-1].split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError, AttributeError):
+        return None
+
+
+class TokenManager:
+    """Хранит JWT SAS в памяти и обновляет его незадолго до истечения.
+
+    Все логины идут под одной блокировкой, поэтому параллельные команды
+    никогда не выполняют /sdk/login одновременно.
+    """
+
+    def __init__(self, ttl=SAS_TOKEN_TTL, refresh_margin=SAS_TOKEN_REFRESH_MARGIN):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self):
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+
+    async def _login(self):
+        token = await get_jwt_token()
+        if not token:
+            self._token = None
+            return None
+        exp = get_jwt_expiry(token)
+        self._token = token
+        self._expires_at = exp if exp is not None else time.time() + self.ttl
+        logger.info("JWT SAS обновлён, действует ещё %.0f с.", self._expires_at - time.time())
+        return token
+
+    async def get_token(self):
+        if self._is_fresh():
+            return self._token
+        async with self._lock:
+            if self._is_fresh():
+                return self._token
+            return await self._login()
+
+    async def refresh(self, stale_token):
+        """Повторный логин после отказа SAS в авторизации с токеном stale_token."""
+        async with self._lock:
+            # Токен уже обновила другая команда, пока мы ждали блокировку
+            if self._token is not None and self._token != stale_token and self._is_fresh():
+                return self._token
+            return await self._login()
+
+
+token_manager = TokenManager()
+
+
+class SasError(Exception):
+    """SAS не вернул данные (HTTP-ошибка, Result != 0 или сбой сети); подробности уже в логе."""
+
+
+class SasUnavailable(SasError):
+    """Circuit breaker разомкнут: запрос к SAS отклонён без обращения к нему."""
+
+    def __init__(self, retry_in):
+        self.retry_in = retry_in
+        super().__init__(f"SAS временно недоступен, повторите примерно через {math.ceil(retry_in)} с")
+
+
+async def sas_get(path, token, data):
+    """GET-запрос к SAS; при ошибке авторизации один раз логинится заново и повторяет запрос."""
+    resp = await sas_client.get(path, data, token)
+    if resp.status_code in SAS_AUTH_FAILURE_CODES:
+        logger.warning("SAS отклонил токен (HTTP %s) для %s, выполняю повторный логин.", resp.status_code, path)
+        new_token = await token_manager.refresh(token)
+        if new_token:
+            resp = await sas_client.get(path, data, new_token)
+    return resp
+
+class ResponseCache:
+    """LRU-кеш ответов SAS с отдельным TTL для каждого эндпоинта.
+
+    Одинаковые запросы, пришедшие, пока первый ещё выполняется, не идут в SAS
+    повторно, а ждут его результат (single-flight). Ключ — эндпоинт, логин
+    и остальные параметры запроса.
+    """
+
+    _RELOAD = object()
+
+    def __init__(self, max_size=CACHE_MAX_SIZE, ttls=CACHE_TTLS):
+        self.max_size = max_size
+        self.ttls = ttls
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.coalesced = Counter()
+
+    async def get_or_load(self, endpoint, user_login, params, loader, cacheable=lambda value: True):
+        key = (endpoint, user_login) + tuple(params)
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits[endpoint] += 1
+                return value
+            del self._entries[key]
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced[endpoint] += 1
+            value = await asyncio.shield(future)
+            if value is self._RELOAD:
+                # Первый запрос отменили — ждущие загружают сами
+                return await self.get_or_load(endpoint, user_login, params, loader, cacheable)
+            return value
+        self.misses[endpoint] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            future.set_result(self._RELOAD)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Помечаем исключение как полученное, даже если ждущих запросов не было
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            ttl = self.ttls.get(endpoint, 0)
+            if ttl > 0 and cacheable(value):
+                self._entries[key] = (time.monotonic() + ttl, value)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate_login(self, user_login):
+        """Удаляет все записи пользователя (без учёта регистра логина), возвращает их число."""
+        login = user_login.strip().lower()
+        keys = [key for key in self._entries if key[1].lower() == login]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def stats(self):
+        endpoints = sorted(set(self.hits) | set(self.misses) | set(self.coalesced))
+        return {
+            endpoint: {
+                "hits": self.hits[endpoint],
+                "misses": self.misses[endpoint],
+                "coalesced": self.coalesced[endpoint],
+            }
+            for endpoint in endpoints
+        }
+
+
+response_cache = ResponseCache()
+
+
+async def get_tokens_for_user(token, user_login, count):
+    tokens = await response_cache.get_or_load(
+        "/sdk/users/user-tokens", user_login, (),
+        lambda: fetch_tokens_for_user(token, user_login),
+        cacheable=lambda value: value is not None,
+    )
+    return (tokens or [])[:count]
+
+
+async def fetch_tokens_for_user(token, user_login):
+    """Все токены пользователя из SAS или None при ошибке."""
+    data = {
+        "org_name": ORG_NAME,
+        "user_login": user_login
+    }
+    try:
+        resp = await sas_get("/sdk/users/user-tokens", token, data)
+        if resp.status_code == 200:
+            body = resp.json()
+            if body.get("Result") == 0:
+                return body.get("Data", [])
+            else:
+                logger.error("Ошибка запроса /sdk/users/user-tokens: %s", body.get("Details", "(нет описания)"))
+        else:
+            logger.error("HTTP ошибка /sdk/users/user-tokens: %s %s", resp.status_code, resp.text)
+    except httpx.HTTPError as e:
+        logger.error("Сетевая ошибка при получении токенов: %s", str(e))
+    return None
+
+
+# Формат audit_datetime в ответах SAS
+AUDIT_DATETIME_FORMAT = "%d-%m-%Y %H:%M:%S"
+# Поле, в котором у записи аудита кешируется ключ сортировки
+AUDIT_SORT_KEY_FIELD = "_audit_sort_key"
+
+
+async def fetch_audit_page(token, user_login, page_number, start_date="", stop_date=""):
+    """Одна страница /sdk/audit/audit. Возвращает список записей или None при ошибке."""
+    data = {
+        "org_name": ORG_NAME,
+        "user_login": user_login,
+        "page_number": page_number,
+        "page_size": AUDIT_PAGE_SIZE,
+    }
+    if start_date:
+        data["start_date"] = start_date
+    if stop_date:
+        data["stop_date"] = stop_date
+    try:
+        resp = await sas_get("/sdk/audit/audit", token, data)
+        if resp.status_code == 200:
+            body = resp.json()
+            if body.get("Result") == 0:
+                return body.get("Data") or []
+            else:
+                logger.error("Ошибка запроса /sdk/audit/audit (страница %s): %s", page_number, body.get("Details", "(нет описания)"))
+        else:
+            logger.error("HTTP ошибка /sdk/audit/audit (страница %s): %s %s", page_number, resp.status_code, resp.text)
+    except httpx.HTTPError as e:
+        logger.error("Сетевая ошибка при получении записей аудита (страница %s): %s", page_number, str(e))
+    return None
+
+
+async def iter_audit_pages(token, user_login, start_date="", stop_date="", max_pages=AUDIT_MAX_PAGES):
+    """Асинхронно выдаёт страницы аудита по порядку.
+
+    Первая страница запрашивается отдельно (у большинства пользователей она
+    единственная), следующие — пачками по AUDIT_PAGE_FANOUT параллельно.
+    Перебор заканчивается на первой неполной странице или после max_pages:
+    ещё не завершённые запросы пачки за ней отменяются. Если страницу
+    получить не удалось, поднимается SasError.
+    """
+    page_number = 1
+    while page_number <= max_pages:
+        fanout = AUDIT_PAGE_FANOUT if page_number > 1 else 1
+        batch = range(page_number, min(page_number + fanout, max_pages + 1))
+        tasks = [
+            asyncio.ensure_future(fetch_audit_page(token, user_login, n, start_date, stop_date))
+            for n in batch
+        ]
+        try:
+            for n, task in zip(batch, tasks):
+                records = await task
+                if records is None:
+                    raise SasError(f"не удалось получить страницу {n} аудита {user_login}")
+                yield records
+                if len(records) < AUDIT_PAGE_SIZE:
+                    return
+        finally:
+            for task in tasks:
+                if task.done() and not task.cancelled():
+                    # Ошибка страницы за неполной уже не важна
+                    task.exception()
+                task.cancel()
+        page_number += len(batch)
+    logger.warning("Аудит %s: достигнут предел AUDIT_MAX_PAGES=%s, остальные страницы пропущены.", user_login, max_pages)
+
+
+def audit_datetime_key(dt_str):
+    """Переводит 'dd-mm-YYYY HH:MM:SS' в целое YYYYMMDDhhmmss без strptime.
+
+    Порядок ключей совпадает с хронологическим. Для значения в другом формате
+    или с полями вне допустимых диапазонов возвращает None (число дней в
+    конкретном месяце не проверяется).
+    """
+    if (
+        not isinstance(dt_str, str)
+        or len(dt_str) != 19
+        or dt_str[2] != "-" or dt_str[5] != "-" or dt_str[10] != " "
+        or dt_str[13] != ":" or dt_str[16] != ":"
+    ):
+        return None
+    digits = dt_str[6:10] + dt_str[3:5] + dt_str[0:2] + dt_str[11:13] + dt_str[14:16] + dt_str[17:19]
+    if not (digits.isascii() and digits.isdigit()):
+        return None
+    # Двузначные поля сравниваются как строки — это то же, что сравнение чисел
+    if not (
+        "01" <= dt_str[0:2] <= "31" and "01" <= dt_str[3:5] <= "12"
+        and dt_str[11:13] <= "23" and dt_str[14:16] <= "59" and dt_str[17:19] <= "59"
+    ):
+        return None
+    return int(digits)
+
+
+def audit_sort_key(record):
+    """Ключ сортировки записи аудита; считается один раз и сохраняется в записи.
+
+    Записи с некорректной датой получают ключ 0 и оказываются самыми старыми.
+    """
+    key = record.get(AUDIT_SORT_KEY_FIELD)
+    if key is None:
+        key = audit_datetime_key(record.get("audit_datetime")) or 0
+        record[AUDIT_SORT_KEY_FIELD] = key
+    return key
+
+
+AUDIT_INCOMPLETE_NOTE = "Внимание: часть страниц аудита не загрузилась, записи могут быть неполными."
+
+
+async def get_audit_logs(token, user_login, count, start_date="", stop_date=""):
+    return await response_cache.get_or_load(
+        "/sdk/audit/audit", user_login, (count, start_date, stop_date),
+        lambda: fetch_audit_logs(token, user_login, count, start_date, stop_date),
+        # Неполный результат (сбой страницы) не кешируется
+        cacheable=lambda value: value[0] and value[1],
+    )
+
+
+async def fetch_audit_logs(token, user_login, count, start_date="", stop_date=""):
+    """Возвращает (до count самых свежих записей аудита, полный ли результат).
+
+    Количество ограничено AUDIT_MAX_COUNT. Если страница не загрузилась,
+    возвращаются записи до неё и False. Записи со всех страниц проходят через min-кучу размера count, поэтому
+    в памяти держится не больше count записей, а не вся история пользователя.
+    """
+    limit = max(1, min(count, AUDIT_MAX_COUNT))
+    heap = []
+    seq = 0
+    bad_dates = 0
+    bad_example = None
+    complete = True
+    try:
+        async with contextlib.aclosing(iter_audit_pages(token, user_login, start_date, stop_date)) as pages:
+            async for records in pages:
+                added = 0
+                for record in records:
+                    key = audit_sort_key(record)
+                    if not key:
+                        bad_dates += 1
+                        bad_example = record.get("audit_datetime")
+                    seq += 1
+                    if len(heap) < limit:
+                        heapq.heappush(heap, (key, seq, record))
+                        added += 1
+                    elif key > heap[0][0]:
+                        heapq.heapreplace(heap, (key, seq, record))
+                        added += 1
+                # SAS отдаёт страницы от новых записей к старым: если куча заполнена
+                # и страница не добавила ничего свежее, дальше искать нечего
+                if len(heap) >= limit and not added:
+                    break
+    except SasError as e:
+        # Отдаём то, что успели получить до сбойной страницы
+        if isinstance(e, SasUnavailable) and not heap:
+            raise
+        logger.error("Аудит %s получен не полностью: %s", user_login, e)
+        complete = False
+    if bad_dates:
+        logger.warning("Аудит %s: %s записей с некорректной датой (например, %r).", user_login, bad_dates, bad_example)
+    heap.sort(reverse=True)
+    return [record for _, _, record in heap], complete
+
+def datetime_to_audit_key(dt):
+    return int(dt.strftime("%Y%m%d%H%M%S"))
+
+
+def format_audit_key(key):
+    """Обратное к audit_datetime_key: целый ключ -> 'dd-mm-YYYY HH:MM:SS'."""
+    digits = f"{key:014d}"
+    return f"{digits[6:8]}-{digits[4:6]}-{digits[0:4]} {digits[8:10]}:{digits[10:12]}:{digits[12:14]}"
+
+
+# Фильтры /audit, которые обслуживаются локальным индексом аудита
+AUDIT_FILTER_KEYS = ("ip", "result", "since", "until", "token")
+AUDIT_FILTER_TIME_FORMATS = (
+    "%d-%m-%Y", "%Y-%m-%d",
+    "%d-%m-%YT%H:%M", "%Y-%m-%dT%H:%M",
+    "%d-%m-%YT%H:%M:%S", "%Y-%m-%dT%H:%M:%S",
+)
+RELATIVE_PERIOD_UNITS = {"m": "minutes", "h": "hours", "d": "days"}
+
+
+def parse_relative_period(value):
+    """'30m', '12h', '7d' -> timedelta или None."""
+    match = re.fullmatch(r"(\d+)([mhd])", value.lower())
+    if match is None:
+        return None
+    return timedelta(**{RELATIVE_PERIOD_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def parse_filter_time(value, end_of_day=False):
+    """Время фильтра since=/until= в ключ audit_datetime_key.
+
+    Понимает относительный период ('7d' — семь дней назад) и даты
+    'dd-mm-YYYY' / 'YYYY-MM-DD', в том числе с временем через 'T'. Дата без
+    времени в until= означает конец дня.
+    """
+    period = parse_relative_period(value)
+    if period is not None:
+        return datetime_to_audit_key(datetime.now() - period)
+    for fmt in AUDIT_FILTER_TIME_FORMATS:
+        try:
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if end_of_day and "T" not in fmt:
+            dt = dt.replace(hour=23, minute=59, second=59)
+        return datetime_to_audit_key(dt)
+    raise ValueError(f"неверная дата '{value}'")
+
+
+def parse_audit_filters(args):
+    """Отделяет фильтры key=value от остальных аргументов /audit.
+
+    Возвращает (аргументы без фильтров, фильтры); ValueError — для
+    неизвестного фильтра или неверного значения.
+    """
+    rest = []
+    audit_filters = {}
+    for arg in args:
+        key, sep, value = arg.partition("=")
+        if not sep:
+            rest.append(arg)
+            continue
+        key = key.lower()
+        if key not in AUDIT_FILTER_KEYS or not value:
+            raise ValueError(f"неизвестный фильтр '{arg}'")
+        if key in ("since", "until"):
+            value = parse_filter_time(value, end_of_day=key == "until")
+        audit_filters[key] = value
+    return rest, audit_filters
+
+
+class AuditStore:
+    """Локальный индекс аудита в SQLite.
+
+    Записи каждого пользователя синхронизируются инкрементально: в SAS
+    запрашивается только хвост начиная с водяного знака — самой свежей
+    audit_datetime на момент последней успешной синхронизации. Водяной знак
+    сдвигается только после того, как все страницы получены, так что сбой
+    посередине не оставляет дыр в истории. Повторы отбрасываются уникальным
+    ключом записи. Если синхронизация упёрлась в AUDIT_MAX_PAGES, более старые
+    записи в индекс не попадают: ключ самой старой полученной записи
+    сохраняется как history_from и показывается в ответах с фильтрами.
+    """
+
+    COLUMNS = (
+        ("audit_login", "audit_login"),
+        ("audit_datetime", "audit_datetime"),
+        ("ip", "audit_ip_address"),
+        ("agent", "audit_agent"),
+        ("result", "audit_result"),
+        ("serial", "audit_serialnumber"),
+        ("comments", "audit_comments"),
+    )
+
+    def __init__(self, path=AUDIT_DB_PATH, sync_interval=AUDIT_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._db = None
+        self._locks = {}
+
+    @property
+    def db(self):
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS audit (
+                    login TEXT NOT NULL,
+                    ts INTEGER NOT NULL,
+                    audit_login TEXT NOT NULL DEFAULT '',
+                    audit_datetime TEXT NOT NULL DEFAULT '',
+                    ip TEXT NOT NULL DEFAULT '',
+                    agent TEXT NOT NULL DEFAULT '',
+                    result TEXT NOT NULL DEFAULT '',
+                    serial TEXT NOT NULL DEFAULT '',
+                    comments TEXT NOT NULL DEFAULT '',
+                    UNIQUE (login, ts, ip, agent, result, serial, comments)
+                );
+                CREATE INDEX IF NOT EXISTS audit_login_ts ON audit (login, ts);
+                CREATE INDEX IF NOT EXISTS audit_login_ip ON audit (login, ip, ts);
+                CREATE INDEX IF NOT EXISTS audit_login_result ON audit (login, result, ts);
+                CREATE INDEX IF NOT EXISTS audit_login_serial ON audit (login, serial, ts);
+                CREATE TABLE IF NOT EXISTS audit_sync (
+                    login TEXT PRIMARY KEY,
+                    synced_at REAL NOT NULL,
+                    watermark INTEGER NOT NULL,
+                    history_from INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS audit_watch (
+                    chat_id INTEGER NOT NULL,
+                    login TEXT NOT NULL,
+                    seen INTEGER NOT NULL,
+                    PRIMARY KEY (chat_id, login)
+                );
+            """)
+            # Индексы, созданные до появления history_from
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(audit_sync)")]
+            if "history_from" not in columns:
+                self._db.execute("ALTER TABLE audit_sync ADD COLUMN history_from INTEGER NOT NULL DEFAULT 0")
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def sync_state(self, user_login):
+        """(время последней синхронизации, водяной знак, history_from) или None, если пользователь ещё не синхронизирован."""
+        return self.db.execute(
+            "SELECT synced_at, watermark, history_from FROM audit_sync WHERE login = ?", (user_login.lower(),)
+        ).fetchone()
+
+    def history_from(self, user_login):
+        """Ключ, с которого в индексе есть полная история пользователя; 0 — вся история."""
+        state = self.sync_state(user_login)
+        return state[2] if state is not None else 0
+
+    def insert(self, user_login, records):
+        """Добавляет записи, пропуская уже известные; возвращает добавленные."""
+        login = user_login.lower()
+        added = []
+        with self.db:
+            for record in records:
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO audit (login, ts, audit_login, audit_datetime, ip, agent, result, serial, comments) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (login, audit_sort_key(record), *(str(record.get(field) or "") for _, field in self.COLUMNS)),
+                )
+                if cursor.rowcount:
+                    added.append(record)
+        return added
+
+    async def sync(self, token, user_login, force=False):
+        """Догружает из SAS записи новее водяного знака; возвращает новые записи.
+
+        Если пользователь синхронизировался меньше sync_interval секунд назад,
+        SAS не запрашивается (кроме force=True). SasError пробрасывается.
+        """
+        login = user_login.lower()
+        lock = self._locks.setdefault(login, asyncio.Lock())
+        async with lock:
+            state = self.sync_state(login)
+            if state is not None and not force and time.time() - state[0] < self.sync_interval:
+                return []
+            watermark = state[1] if state is not None else 0
+            history_from = state[2] if state is not None else 0
+            start_date = format_audit_key(watermark) if watermark else ""
+            newest = watermark
+            oldest = None
+            pages_read = 0
+            reached_end = False
+            added = []
+            async with contextlib.aclosing(iter_audit_pages(token, user_login, start_date)) as pages:
+                async for records in pages:
+                    pages_read += 1
+                    added.extend(self.insert(login, records))
+                    keys = [audit_sort_key(record) for record in records]
+                    newest = max([newest, *keys])
+                    oldest = min([key for key in keys if key] + ([oldest] if oldest else []), default=None)
+                    if len(records) < AUDIT_PAGE_SIZE:
+                        reached_end = True
+                    # Страницы идут от новых записей к старым: страница целиком
+                    # старше водяного знака значит, что хвост уже получен
+                    if watermark and keys and max(keys) < watermark:
+                        reached_end = True
+                        break
+            if not reached_end and pages_read >= AUDIT_MAX_PAGES and oldest:
+                # Всё, что старше последней полученной страницы, в индекс не попало
+                history_from = max(history_from, oldest)
+                logger.warning("Индекс аудита %s неполон: история раньше %s не загружена.", user_login, format_audit_key(oldest))
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO audit_sync (login, synced_at, watermark, history_from) VALUES (?, ?, ?, ?)",
+                    (login, time.time(), newest, history_from),
+                )
+            if added:
+                logger.info("Индекс аудита %s: добавлено %s записей.", user_login, len(added))
+            return added
+
+    def query(self, user_login, audit_filters, limit):
+        """Свежие записи пользователя из индекса с учётом фильтров ip/result/since/until/token."""
+        clauses = ["login = ?"]
+        params = [user_login.lower()]
+        ip = audit_filters.get("ip")
+        if ip is not None:
+            if ip.endswith("*"):
+                clauses.append("ip LIKE ?")
+                params.append(ip[:-1] + "%")
+            else:
+                clauses.append("ip = ?")
+                params.append(ip)
+        if "result" in audit_filters:
+            clauses.append("result LIKE ?")
+            params.append(f"%{audit_filters['result']}%")
+        if "token" in audit_filters:
+            clauses.append("serial = ?")
+            params.append(audit_filters["token"])
+        if "since" in audit_filters:
+            clauses.append("ts >= ?")
+            params.append(audit_filters["since"])
+        if "until" in audit_filters:
+            clauses.append("ts <= ?")
+            params.append(audit_filters["until"])
+        columns = ", ".join(column for column, _ in self.COLUMNS)
+        rows = self.db.execute(
+            f"SELECT {columns} FROM audit WHERE {' AND '.join(clauses)} ORDER BY ts DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+        return [{field: value for (_, field), value in zip(self.COLUMNS, row)} for row in rows]
+
+    def add_watch(self, chat_id, user_login):
+        """Подписывает чат на новые записи пользователя; уже известные записи в уведомления не попадут."""
+        login = user_login.lower()
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO audit_watch (chat_id, login, seen) "
+                "SELECT ?, ?, COALESCE(MAX(rowid), 0) FROM audit WHERE login = ?",
+                (chat_id, login, login),
+            )
+        return cursor.rowcount > 0
+
+    def remove_watch(self, chat_id, user_login):
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM audit_watch WHERE chat_id = ? AND login = ?", (chat_id, user_login.lower())
+            )
+        return cursor.rowcount > 0
+
+    def watches(self, chat_id=None):
+        """Подписки [(chat_id, login, seen)], где seen — rowid последней показанной записи."""
+        if chat_id is None:
+            return self.db.execute("SELECT chat_id, login, seen FROM audit_watch ORDER BY login").fetchall()
+        return self.db.execute(
+            "SELECT chat_id, login, seen FROM audit_watch WHERE chat_id = ? ORDER BY login", (chat_id,)
+        ).fetchall()
+
+    def watch_events(self, user_login, seen):
+        """Записи новее rowid seen: (последний rowid, [(запись, IP раньше не встречался)])."""
+        login = user_login.lower()
+        columns = ", ".join(column for column, _ in self.COLUMNS)
+        rows = self.db.execute(
+            f"SELECT rowid, {columns} FROM audit WHERE login = ? AND rowid > ? ORDER BY ts", (login, seen)
+        ).fetchall()
+        known = {}
+        events = []
+        for rowid, *values in rows:
+            record = {field: value for (_, field), value in zip(self.COLUMNS, values)}
+            ip = record["audit_ip_address"]
+            if ip not in known:
+                known[ip] = self.db.execute(
+                    "SELECT 1 FROM audit WHERE login = ? AND ip = ? AND rowid <= ? LIMIT 1", (login, ip, seen)
+                ).fetchone() is not None
+            events.append((record, not known[ip]))
+            seen = max(seen, rowid)
+        return seen, events
+
+    def mark_seen(self, chat_id, user_login, seen):
+        with self.db:
+            self.db.execute(
+                "UPDATE audit_watch SET seen = ? WHERE chat_id = ? AND login = ?", (seen, chat_id, user_login.lower())
+            )
+
+
+audit_store = AuditStore()
+
+
+def is_audit_failure(record):
+    """Неудачная попытка — как в фильтре result=fail."""
+    return "fail" in str(record.get("audit_result") or "").lower()
+
+
+def format_watch_alert(user_login, events):
+    """Текст уведомления /watch: неудачные входы и входы с новых IP, или None, если сообщать не о чем."""
+    lines = []
+    for record, new_ip in events:
+        failure = is_audit_failure(record)
+        if not failure and not new_ip:
+            continue
+        marks = [mark for mark, hit in (("неудача", failure), ("новый IP", new_ip)) if hit]
+        lines.append(
+            f"{record.get('audit_datetime', '')}  {record.get('audit_ip_address', '')}  "
+            f"{record.get('audit_result', '')}  [{', '.join(marks)}]"
+        )
+    if not lines:
+        return None
+    shown = lines[-WATCH_ALERT_MAX_LINES:]
+    header = f"Аудит `{user_login}`: подозрительных событий — {len(lines)}"
+    if len(lines) > len(shown):
+        header += f", последние {len(shown)}"
+    return header + "\n```\n" + "\n".join(shown) + "\n```"
+
+
+class AuditWatcher:
+    """Фоновый опрос аудита логинов из /watch.
+
+    Все подписки обрабатываются одним тиком раз в WATCH_INTERVAL секунд с
+    ограниченной параллельностью. Каждый логин синхронизируется через
+    audit_store, то есть из SAS приходит только хвост новее водяного знака.
+    Логины без новой активности опрашиваются всё реже, вплоть до
+    WATCH_MAX_INTERVAL, поэтому нагрузка на SAS растёт вместе с
+    активностью, а не с числом подписок. Что уже показано, каждая подписка
+    помнит по rowid индекса, так что записи, догруженные другими
+    командами, тоже не теряются и не повторяются.
+    """
+
+    def __init__(self, store, interval=WATCH_INTERVAL, max_interval=WATCH_MAX_INTERVAL, concurrency=WATCH_CONCURRENCY):
+        self.store = store
+        self.interval = interval
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        # login -> (текущий интервал опроса, когда опрашивать в следующий раз)
+        self._schedule = {}
+        self._task = None
+
+    def start(self, bot):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self, bot):
+        sas_heavy.set(True)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick(bot)
+            except Exception:
+                logger.exception("Ошибка фонового опроса аудита")
+
+    async def tick(self, bot):
+        subscriptions = {}
+        for chat_id, login, seen in self.store.watches():
+            subscriptions.setdefault(login, []).append((chat_id, seen))
+        now = time.monotonic()
+        due = [login for login in subscriptions if self._schedule.get(login, (0, 0))[1] <= now]
+        if not due:
+            return
+        try:
+            token = await token_manager.get_token()
+        except SasUnavailable as e:
+            logger.warning("Опрос аудита пропущен: %s", e)
+            return
+        if not token:
+            logger.error("Опрос аудита пропущен: не удалось получить JWT")
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def poll(login):
+            async with semaphore:
+                try:
+                    added = await self.store.sync(token, login, force=True)
+                except SasError as e:
+                    logger.warning("Опрос аудита %s не удался: %s", login, e)
+                    added = []
+            interval = self._schedule.get(login, (self.interval, 0))[0]
+            interval = self.interval if added else min(interval * 2, self.max_interval)
+            self._schedule[login] = (interval, time.monotonic() + interval)
+            for chat_id, seen in subscriptions[login]:
+                self.notify(bot, chat_id, login, seen)
+
+        await asyncio.gather(*(poll(login) for login in due))
+        # Логины без подписок больше не планируем
+        for login in set(self._schedule) - set(subscriptions):
+            del self._schedule[login]
+
+    def notify(self, bot, chat_id, user_login, seen):
+        seen_after, events = self.store.watch_events(user_login, seen)
+        if seen_after == seen:
+            return
+        text = format_watch_alert(user_login, events)
+        if text is not None:
+            logger.info("Аудит %s: уведомление в чат %s", user_login, chat_id)
+            outbox.send_message(bot, chat_id, text, parse_mode=ParseMode.MARKDOWN)
+        self.store.mark_seen(chat_id, user_login, seen_after)
+
+
+audit_watcher = AuditWatcher(audit_store)
+
+# Поля записи аудита в выгрузке и их подписи для текстового формата
+AUDIT_EXPORT_FIELDS = [
+    ("audit_login", "Логин"),
+    ("audit_datetime", "Время"),
+    ("audit_ip_address", "IP"),
+    ("audit_agent", "Агент"),
+    ("audit_result", "Результат"),
+    ("audit_serialnumber", "Номер токена"),
+    ("audit_comments", "Комментарий"),
+]
+AUDIT_EXPORT_FORMATS = ("txt", "csv", "jsonl")
+
+
+def parse_export_format(arg):
+    """'csv', 'jsonl.gz', 'gz' и т.п. -> (формат, сжатие) или None для неизвестного формата."""
+    arg = arg.lower().lstrip(".")
+    if arg == "gz":
+        return "txt", True
+    compress = arg.endswith(".gz")
+    fmt = arg[:-3] if compress else arg
+    if fmt not in AUDIT_EXPORT_FORMATS:
+        return None
+    return fmt, compress
+
+
+def iter_audit_export(records, fmt):
+    """Генератор строк выгрузки записей аудита в формате txt, csv или jsonl."""
+    if fmt == "csv":
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+
+        def row(values):
+            writer.writerow(values)
+            line = buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            return line
+
+        yield row([field for field, _ in AUDIT_EXPORT_FIELDS])
+        for record in records:
+            yield row([record.get(field, "") for field, _ in AUDIT_EXPORT_FIELDS])
+    elif fmt == "jsonl":
+        for record in records:
+            yield json.dumps({field: record.get(field, "") for field, _ in AUDIT_EXPORT_FIELDS}, ensure_ascii=False) + "\n"
+    else:
+        for record in records:
+            yield "".join(f"{title}: {record.get(field, '')}\n" for field, title in AUDIT_EXPORT_FIELDS) + "\n"
+
+
+def spool_export(chunks, compress=False):
+    """Пишет строки во временный файл (при необходимости через gzip) и возвращает его с начала.
+
+    До EXPORT_SPOOL_MAX_SIZE байт файл живёт в памяти, дальше — на диске,
+    так что объём выгрузки не влияет на пиковое потребление памяти.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
+    sink = gzip.GzipFile(fileobj=spool, mode="wb") if compress else spool
+    for chunk in chunks:
+        sink.write(chunk.encode("utf-8"))
+    if compress:
+        # Закрывает только gzip-поток, сам spool остаётся открытым
+        sink.close()
+    spool.seek(0)
+    return spool
+
+
+class SpaceSaving:
+    """Приближённый top-K за один проход (алгоритм Space-Saving).
+
+    Хранит не больше capacity счётчиков. Новое значение при заполненной
+    таблице вытесняет самый малый счётчик и наследует его величину; она же
+    запоминается как возможная переоценка. Значения с частотой больше
+    n / capacity гарантированно попадают в таблицу.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, item):
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [1, 0]
         else:
-            logger.error("HTTP ошибка /sdk/users/user-tokens: %s %s", resp.status_code, resp.text)
-    except requests.exceptions.RequestException as e:
-        logger.error("Сетевая ошибка при получении токенов: %s", str(e))
-    return []
+            victim = min(self.counts, key=lambda key: self.counts[key][0])
+            count = self.counts.pop(victim)[0]
+            self.counts[item] = [count + 1, count]
 
+    def top(self, k):
+        """[(значение, счётчик, возможная переоценка)] по убыванию счётчика."""
+        ranked = sorted(self.counts.items(), key=lambda item: item[1][0], reverse=True)[:k]
+        return [(item, count, error) for item, (count, error) in ranked]
 
-def parse_datetime(dt_str):
-    try:
-        return datetime.strptime(dt_str, "%d-%m-%Y %H:%M:%S")
-    except Exception as e:
-        logger.error("Ошибка преобразования даты '%s': %s", dt_str, e)
+
+class AuditStats:
+    """Агрегаты по потоку записей аудита в постоянной памяти.
+
+    Результаты и номера токенов считаются точно (их мало), IP и агенты —
+    через SpaceSaving. Ряд строится по часам или по дням: корзина — это
+    префикс целого ключа audit_datetime_key, без разбора даты.
+    """
+
+    def __init__(self, hourly=True, top_capacity=AUDITSTATS_COUNTERS):
+        self.hourly = hourly
+        self.divisor = 10 ** 4 if hourly else 10 ** 6
+        self.total = 0
+        self.failures = 0
+        self.first = None
+        self.last = None
+        self.results = Counter()
+        self.ips = SpaceSaving(top_capacity)
+        self.agents = SpaceSaving(top_capacity)
+        # номер токена -> [записей, неудач]
+        self.serials = {}
+        # корзина -> [записей, неудач]
+        self.buckets = {}
+
+    def add(self, record, key):
+        failure = is_audit_failure(record)
+        self.total += 1
+        self.failures += failure
+        self.first = key if self.first is None else min(self.first, key)
+        self.last = key if self.last is None else max(self.last, key)
+        self.results[str(record.get("audit_result") or "—")] += 1
+        self.ips.add(str(record.get("audit_ip_address") or "—"))
+        self.agents.add(str(record.get("audit_agent") or "—"))
+        serial = self.serials.setdefault(str(record.get("audit_serialnumber") or "—"), [0, 0])
+        serial[0] += 1
+        serial[1] += failure
+        bucket = self.buckets.setdefault(key // self.divisor, [0, 0])
+        bucket[0] += 1
+        bucket[1] += failure
+
+    def bucket_label(self, bucket):
+        digits = f"{bucket * self.divisor:014d}"
+        label = f"{digits[0:4]}-{digits[4:6]}-{digits[6:8]}"
+        return f"{label} {digits[8:10]}:00" if self.hourly else label
+
+    def summary(self, user_login, period, top_k=AUDITSTATS_TOP_K):
+        lines = [f"Записей: {self.total}, неудачных: {self.failures}"]
+        if self.total:
+            lines.append(f"Период данных: {format_audit_key(self.first)} — {format_audit_key(self.last)}")
+        lines.append("")
+        lines.append("Результаты:")
+        lines.extend(f"  {result}: {count}" for result, count in self.results.most_common())
+        for title, top in (("Топ IP:", self.ips), ("Топ агентов:", self.agents)):
+            lines.append(title)
+            for item, count, error in top.top(top_k):
+                lines.append(f"  {item}: {count}" + (f" (±{error})" if error else ""))
+        lines.append("Токены (записей / неудач):")
+        for serial, (count, failures) in sorted(self.serials.items(), key=lambda item: item[1][0], reverse=True):
+            lines.append(f"  {serial}: {count} / {failures}")
+        if self.buckets:
+            peak = max(self.buckets, key=lambda bucket: self.buckets[bucket][0])
+            worst = max(self.buckets, key=lambda bucket: self.buckets[bucket][1])
+            step = "час" if self.hourly else "день"
+            lines.append(f"Пиковый {step}: {self.bucket_label(peak)} — {self.buckets[peak][0]} записей")
+            if self.buckets[worst][1]:
+                lines.append(f"Больше всего неудач: {self.bucket_label(worst)} — {self.buckets[worst][1]}")
+        return f"*Статистика аудита* `{user_login}` за {period}:\n```\n" + "\n".join(lines) + "\n```"
+
+    def iter_series_csv(self):
+        """Ряд по корзинам в CSV, включая пустые часы/дни между первой и последней записью."""
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["period", "total", "failures"])
+        if self.buckets:
+            start = datetime.strptime(str(min(self.buckets) * self.divisor), "%Y%m%d%H%M%S")
+            end = max(self.buckets)
+            step = timedelta(hours=1) if self.hourly else timedelta(days=1)
+            while (bucket := datetime_to_audit_key(start) // self.divisor) <= end:
+                count, failures = self.buckets.get(bucket, (0, 0))
+                writer.writerow([self.bucket_label(bucket), count, failures])
+                start += step
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+
+class ProgressMessage:
+    """Сообщение о ходе долгой операции.
+
+    Отправляется при первом обновлении, дальше редактируется не чаще раза
+    в interval секунд и удаляется по завершении. Правки идут через лимит
+    чата, поэтому interval не бывает меньше 60 / TELEGRAM_CHAT_RATE — иначе
+    прогресс отнимал бы весь бюджет отправки у ответов. Ошибки Telegram при
+    этом игнорируются: прогресс не должен ломать саму команду.
+    """
+
+    def __init__(self, message, interval):
+        self.interval = max(interval, 60 / TELEGRAM_CHAT_RATE)
+        self._reply_to = message
+        self._text = ""
+        self._shown = None
+        self._sent = None
+        self._edit_pending = None
+        self._last_update = time.monotonic()
+
+    async def update(self, text, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_update < self.interval:
+            return
+        self._last_update = now
+        # Отправка идёт через очередь чата и не задерживает команду;
+        # правка, которая ещё ждёт очереди, просто покажет последний текст
+        self._text = text
+        if self._sent is None:
+            self._sent = outbox.submit(self._reply_to.chat_id, self._send)
+        elif self._edit_pending is None or self._edit_pending.done():
+            self._edit_pending = outbox.submit(self._reply_to.chat_id, self._edit)
+
+    async def close(self):
+        if self._sent is not None:
+            outbox.submit(self._reply_to.chat_id, functools.partial(self._delete, self._sent))
+            self._sent = None
+
+    async def _send(self):
+        self._shown = self._text
+        return await self._reply_to.reply_text(self._text)
+
+    async def _edit(self):
+        message = await self._sent
+        if message is not None and self._shown != self._text:
+            self._shown = self._text
+            with contextlib.suppress(TelegramError):
+                await message.edit_text(self._text)
+
+    @staticmethod
+    async def _delete(sent):
+        message = await sent
+        if message is not None:
+            with contextlib.suppress(TelegramError):
+                await message.delete()
+
+
+def is_login_list_file(document):
+    """Список логинов принимается только из .txt/.csv."""
+    name = (document.file_name or "").lower()
+    if name:
+        return name.endswith((".txt", ".csv"))
+    return document.mime_type in ("text/plain", "text/csv")
+
+
+def batch_document(update, logins):
+    """Документ со списком логинов: во вложении самой команды или, если логины
+    не указаны, в сообщении, на которое она отвечает."""
+    message = update.message
+    document = message.document
+    if document is None and not logins and message.reply_to_message is not None:
+        document = message.reply_to_message.document
+    if document is None or not is_login_list_file(document):
         return None
+    return document
 
-def get_audit_logs(token, user_login, count, start_date="", stop_date=""):
-    limit = min(count, 100)
-    url = f"{BASE_URL}/sdk/audit/audit"
-    headers = {"Authorization": token, "Content-Type": "application/json"}
-    data = {"org_name": ORG_NAME, "user_login": user_login, "page_number": 1, "page_size": 200}
-    if start_date:
-        data["start_date"] = start_date
-    if stop_date:
-        data["stop_date"] = stop_date
+
+def parse_login_list(text):
+    """Логины из .txt/.csv: первый столбец каждой строки, без заголовка и повторов."""
+    logins = []
+    seen = set()
+    for row in csv.reader(io.StringIO(text), delimiter=";" if ";" in text else ","):
+        if not row:
+            continue
+        for login in row[0].split():
+            if login.lower() in ("login", "логин", "user_login") or login.lower() in seen:
+                continue
+            seen.add(login.lower())
+            logins.append(login)
+    return logins
+
+
+def is_batch_request(update, logins):
+    return batch_document(update, logins) is not None or len(logins) > 1
+
+
+async def collect_batch_logins(update, logins):
+    """Логины из аргументов команды и приложенного файла (без повторов)."""
+    document = batch_document(update, logins)
+    logins = list(logins)
+    if document is not None:
+        if document.file_size and document.file_size > BATCH_MAX_FILE_SIZE:
+            raise ValueError(f"файл больше {BATCH_MAX_FILE_SIZE // 1024} КБ")
+        file = await document.get_file()
+        data = await file.download_as_bytearray()
+        logins.extend(parse_login_list(bytes(data).decode("utf-8-sig", errors="replace")))
+    unique = list({login.lower(): login for login in logins}.values())
+    if len(unique) > BATCH_MAX_LOGINS:
+        raise ValueError(f"не больше {BATCH_MAX_LOGINS} логинов за раз")
+    return unique
+
+
+async def batch_tokens(token, user_login):
+    tokens = await get_tokens_for_user(token, user_login, N)
+    if not tokens:
+        return None, "Токены не найдены или произошла ошибка."
+    lines = []
+    for t in tokens:
+        state = "Активен" if t.get("token_activation") else "Не активен"
+        lines.append(f"ID: {t.get('token_id')}\nТип: {t.get('token_type', 'Unknown')}\nСтатус: {state}\n\n")
+    return "".join(lines), None
+
+
+async def batch_enrollments(token, user_login):
+    enrollment_tasks, errors = await get_enrollment_tasks_universal(token, user_login)
+    if errors:
+        return None, "; ".join(errors)
+    if not enrollment_tasks:
+        return "Задачи активации отсутствуют.\n\n", None
+    return "".join(
+        f"ID: {task.get('enrollment_id')}\n"
+        f"Дата окончания: {task.get('enrollment_stop_date', '')}\n"
+        f"Ссылка: {task.get('enrollment_url', '')}\n\n"
+        for task in enrollment_tasks
+    ), None
+
+
+def batch_audit(count):
+    async def lookup(token, user_login):
+        audit_logs, complete = await get_audit_logs(token, user_login, count)
+        if not audit_logs:
+            return None, "Записи аудита не найдены или произошла ошибка."
+        section = "".join(iter_audit_export(audit_logs, "txt"))
+        if not complete:
+            section = AUDIT_INCOMPLETE_NOTE + "\n" + section
+        return section, None
+    return lookup
+
+
+async def run_batch(update, title, name, logins, lookup):
+    """Выполняет lookup(token, login) для всех логинов и отправляет один сводный файл.
+
+    Запросы к SAS идут параллельно (не больше BATCH_CONCURRENCY) с одним JWT.
+    Разделы пишутся в файл по мере готовности, ошибки собираются в отдельный
+    раздел в конце.
+    """
     try:
-        resp = requests.get(url, headers=headers, data=json.dumps(data), timeout=10, verify=False)
-        if resp.status_code == 200:
-            body = resp.json()
-            if body.get("Result") == 0:
-                audit_logs = body.get("Data", [])
-                audit_logs.sort(
-                    key=lambda x: parse_datetime(x.get("audit_datetime", "01-01-1970 00:00:00")) or datetime.min,
-                    reverse=True
-                )
-                return audit_logs[:limit]
-            else:
-                logger.error("Ошибка запроса /sdk/audit/audit: %s", body.get("Details", "(нет описания)"))
+        logins = await collect_batch_logins(update, logins)
+    except (ValueError, TelegramError) as e:
+        outbox.reply_text(update.message, f"Не удалось прочитать список логинов: {e}")
+        return
+    if not logins:
+        outbox.reply_text(update.message, "Список логинов пуст.")
+        return
+    jwt_token = await token_manager.get_token()
+    if not jwt_token:
+        outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
+        return
+    progress = ProgressMessage(update.message, BATCH_PROGRESS_INTERVAL)
+    await progress.update(f"{title}: обработано 0 из {len(logins)}...", force=True)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    report = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
+    failures = []
+    done = 0
+
+    async def one(user_login):
+        nonlocal done
+        async with semaphore:
+            try:
+                section, error = await lookup(jwt_token, user_login)
+            except Exception as e:
+                logger.exception("Ошибка пакетного запроса для %s", user_login)
+                section, error = None, str(e)
+        if error is None:
+            report.write(f"===== {user_login} =====\n{section}".encode("utf-8"))
         else:
-            logger.error("HTTP ошибка /sdk/audit/audit: %s %s", resp.status_code, resp.text)
-    except requests.exceptions.RequestException as e:
-        logger.error("Сетевая ошибка при получении записей аудита: %s", str(e))
-    return []
+            failures.append((user_login, error))
+        done += 1
+        await progress.update(f"{title}: обработано {done} из {len(logins)}...")
+
+    try:
+        await asyncio.gather(*(one(user_login) for user_login in logins))
+        if failures:
+            report.write("===== Ошибки =====\n".encode("utf-8"))
+            for user_login, error in failures:
+                report.write(f"{user_login}: {error}\n".encode("utf-8"))
+        report.seek(0)
+        await progress.close()
+        await outbox.reply_document(
+            update.message,
+            document=InputFile(report, filename=f"{name}_batch.txt", read_file_handle=False),
+            caption=f"{title}: {len(logins) - len(failures)} из {len(logins)} логинов, ошибок: {len(failures)}"
+        )
+    finally:
+        await progress.close()
+        report.close()
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
@@ -117,20 +2203,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Я бот для получения информации о токенах, аудите и получения ID чата.\n\n"
         "*Доступные команды:*\n"
         "• `/tokens <логин>` — получить список токенов для пользователя.\n"
-        "• `/audit <логин> [количество]` — получить записи аудита для пользователя. Если указано количество, результаты будут отправлены файлом.\n"
+        "• `/audit <логин> [количество] [формат]` — получить записи аудита для пользователя. Если указано количество, результаты будут отправлены файлом (`txt`, `csv`, `jsonl`, с суффиксом `.gz` — сжатый).\n"
         "• `/enrollments <логин>` — получить список задач активации для пользователя.\n"
         "• `/getchatid` — получить идентификатор чата.\n"
         "• `/help` — справка по командам.\n\n"
         "• `/activelink` — cсылки на задачи активации.\n\n"
         "• `/sshlogs 'логин'` — получить логи через SSH (как на скриншоте).\n\n"
+        "• `/refresh <логин>` — сбросить кеш ответов SAS для пользователя.\n\n"
+        "• `/auditstats <логин> [период]` — сводка аудита за период (по умолчанию 7d) и CSV-ряд по часам или дням.\n\n"
+        "• `/watch <логин>` / `/unwatch <логин>` — включить или выключить уведомления о неудачных входах и входах с новых IP.\n\n"
+        "• `/stats` — статистика задержек, ошибок и кеша.\n\n"
+        "• `/cancel` — отменить свои команды, ожидающие в очереди.\n\n"
+        "`/tokens`, `/enrollments` и `/audit` принимают несколько логинов или файл `.txt`/`.csv` со списком — результат придёт одним файлом.\n\n"
         "Например:\n"
         "• `/enrollments ivanova`\n"
         "• `/tokens ivanova`\n"
         "• `/audit ivanova 5`\n"
+        "• `/audit ivanova ip=10.0.1.* result=fail since=7d`\n"
         "• `/getchatid`\n"
         "• `/activelink ivanova`"
     )
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    outbox.reply_text(update.message, message, parse_mode=ParseMode.MARKDOWN)
 
 async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
@@ -140,30 +2233,54 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• `/start` — Приветственное сообщение с перечнем команд.\n"
         "• `/tokens <логин>` — Получить список токенов для указанного пользователя.\n"
         "   _Пример:_ `/tokens ivanova`\n\n"
-        "• `/audit <логин> [количество]` — Получить записи аудита для указанного пользователя.\n"
-        "   _Пример:_ `/audit ivanova 5`\n"
-        "   Если количество указано, бот отправит текстовый файл с результатами.\n\n"
+        "• `/audit <логин> [количество] [формат]` — Получить записи аудита для указанного пользователя.\n"
+        "   _Пример:_ `/audit ivanova 5`, `/audit ivanova 500 csv.gz`\n"
+        "   Если количество указано, бот отправит файл с результатами: `txt` (по умолчанию), `csv` или `jsonl`; суффикс `.gz` сжимает файл.\n"
+        "   Фильтры `ip=`, `result=`, `token=`, `since=`, `until=` ищут по локальному индексу аудита "
+        "(`ip=` понимает шаблон `*`, `since=`/`until=` — дату `dd-mm-YYYY` или период `30m`, `12h`, `7d`).\n"
+        "   _Пример:_ `/audit ivanova ip=10.0.1.* result=fail since=7d`\n\n"
         "• `/sshlogs 'логин'` — Получить логи через SSH в формате как на скриншоте.\n"
         "   _Пример:_ `/sshlogs 'ivanova'`\n\n"
+        "• `/refresh <логин>` — Сбросить кеш ответов SAS для пользователя, чтобы следующий запрос получил свежие данные.\n"
+        "   _Пример:_ `/refresh ivanova`\n\n"
+        "• `/auditstats <логин> [период]` — Сводка аудита за период: результаты, топ IP и агентов, "
+        "токены, пиковые часы; ряд по часам (до 7 дней) или дням придёт CSV-файлом. "
+        "Период — `30m`, `12h`, `7d` или дата начала `dd-mm-YYYY`, по умолчанию `7d`.\n"
+        "   _Пример:_ `/auditstats ivanova 24h`\n\n"
+        "• `/watch <логин>` — Следить за аудитом пользователя: бот сам сообщит в чат о неудачных входах и входах с IP, "
+        "которых раньше не было в истории. Без логина — список наблюдаемых.\n"
+        "   _Пример:_ `/watch ivanova petrov`\n\n"
+        "• `/unwatch <логин>` — Выключить наблюдение.\n"
+        "   _Пример:_ `/unwatch ivanova`\n\n"
+        "• Пакетный режим: `/tokens`, `/enrollments` и `/audit` принимают несколько логинов "
+        "или файл `.txt`/`.csv` со списком (команда в подписи к файлу или ответом на сообщение с файлом). "
+        "Бот пришлёт один сводный файл с разделом на каждый логин и отдельным списком ошибок.\n"
+        "   _Пример:_ `/tokens ivanova petrov sidorov`, `/audit ivanova petrov 20`\n\n"
+        "• `/cancel` — Отменить свои команды, которые ждут в очереди. Когда бот загружен, тяжёлые команды "
+        "(выгрузки, `/sshlogs`, `/auditstats`, пакетные запросы) встают в очередь, и бот сообщает позицию.\n\n"
+        "• `/stats` — Задержки команд, SAS, SSH и Telegram (p50/p95/p99), счётчики ошибок, размеры ответов и статистика кеша.\n\n"
         "• `/getchatid` — Получить идентификатор чата, из которого отправлено сообщение."
     )
-    await update.message.reply_text(help_message, parse_mode=ParseMode.MARKDOWN)
+    outbox.reply_text(update.message, help_message, parse_mode=ParseMode.MARKDOWN)
 
 async def tokens_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
         return
+    if is_batch_request(update, context.args or []):
+        await run_batch(update, "Токены", "tokens", context.args or [], batch_tokens)
+        return
     if not context.args:
-        await update.message.reply_text("Пожалуйста, укажите логин. Пример: `/tokens ivanova`", parse_mode=ParseMode.MARKDOWN)
+        outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/tokens ivanova`", parse_mode=ParseMode.MARKDOWN)
         return
     user_login = context.args[0]
     #await update.message.reply_text(
     #    f"Запрашиваю токены для пользователя: *{user_login}* ...", parse_mode=ParseMode.MARKDOWN
     #)
-    jwt_token = get_jwt_token()
+    jwt_token = await token_manager.get_token()
     if not jwt_token:
-        await update.message.reply_text("Ошибка авторизации. Попробуйте позже.")
+        outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
         return
-    tokens = get_tokens_for_user(jwt_token, user_login, N)
+    tokens = await get_tokens_for_user(jwt_token, user_login, N)
     if tokens:
         response_lines = ["*Список токенов:*"]
         for t in tokens:
@@ -179,55 +2296,120 @@ async def tokens_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             response_lines.append(token_message)
         response = "\n".join(response_lines)
-        await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
+        outbox.reply_text(update.message, response, parse_mode=ParseMode.MARKDOWN)
     else:
-        await update.message.reply_text("Токены не найдены или произошла ошибка.")
+        outbox.reply_text(update.message, "Токены не найдены или произошла ошибка.")
+
+def split_audit_args(args):
+    """Разделяет аргументы /audit на логины и количество записей.
+
+    Логины — аргументы до количества; всё после него (формат и прочее)
+    разбирает обычный режим. Форматы и фильтры отбрасываются.
+    """
+    logins = []
+    count = None
+    for arg in args:
+        if arg.isdigit():
+            count = int(arg)
+            break
+        if parse_export_format(arg) is None and "=" not in arg:
+            logins.append(arg)
+    return logins, count
+
 
 async def audit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
         return
-    if not context.args:
-        await update.message.reply_text("Пожалуйста, укажите логин. Пример: `/audit ivanova`", parse_mode=ParseMode.MARKDOWN)
+    batch_logins, batch_count = split_audit_args(context.args or [])
+    if is_batch_request(update, batch_logins):
+        if any("=" in arg for arg in context.args or []):
+            outbox.reply_text(update.message, "Фильтры работают только для одного логина. Уберите фильтры или оставьте один логин.")
+            return
+        await run_batch(update, "Аудит", "audit", batch_logins, batch_audit(batch_count or N))
         return
-    user_login = context.args[0]
+    try:
+        args, audit_filters = parse_audit_filters(context.args or [])
+    except ValueError as e:
+        outbox.reply_text(
+            update.message,
+            f"Ошибка в фильтре: {e}. Доступные фильтры: " + ", ".join(f"`{key}=`" for key in AUDIT_FILTER_KEYS),
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+    if not args:
+        outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/audit ivanova`", parse_mode=ParseMode.MARKDOWN)
+        return
+    user_login = args[0]
     # Если указан второй аргумент, считаем его количеством записей
-    if len(context.args) > 1:
+    if len(args) > 1:
         try:
-            count_arg = int(context.args[1])
+            count_arg = int(args[1])
         except ValueError:
             count_arg = N
         send_file = True
     else:
         count_arg = N
         send_file = False
+    # Третий аргумент — формат файла выгрузки
+    export_format = ("txt", False)
+    if len(args) > 2:
+        export_format = parse_export_format(args[2])
+        if export_format is None:
+            formats = ", ".join(f"`{f}`, `{f}.gz`" for f in AUDIT_EXPORT_FORMATS)
+            outbox.reply_text(update.message, f"Неизвестный формат. Доступные форматы: {formats}", parse_mode=ParseMode.MARKDOWN)
+            return
 
     #await update.message.reply_text(
     #    f"Запрашиваю записи аудита для пользователя: *{user_login}* ...", parse_mode=ParseMode.MARKDOWN
     #)
-    jwt_token = get_jwt_token()
-    if not jwt_token:
-        await update.message.reply_text("Ошибка авторизации. Попробуйте позже.")
-        return
-    audit_logs = get_audit_logs(jwt_token, user_login, count_arg)
+    if audit_filters:
+        # Фильтры обслуживает локальный индекс; из SAS догружается только новый хвост
+        try:
+            jwt_token = await token_manager.get_token()
+        except SasError as e:
+            logger.error("Не удалось получить JWT для синхронизации индекса аудита: %s", e)
+            jwt_token = None
+        stale = not jwt_token
+        if jwt_token:
+            try:
+                await audit_store.sync(jwt_token, user_login)
+            except SasError as e:
+                logger.error("Не удалось синхронизировать индекс аудита: %s", e)
+                stale = True
+        limit = max(1, min(count_arg, AUDIT_MAX_COUNT))
+        audit_logs = audit_store.query(user_login, audit_filters, limit)
+        complete = True
+        if stale:
+            outbox.reply_text(update.message, "SAS недоступен, показываю записи из локального индекса — они могут быть неполными.")
+        history_from = audit_store.history_from(user_login)
+        if history_from and len(audit_logs) < limit and audit_filters.get("since", 0) < history_from:
+            outbox.reply_text(
+                update.message,
+                f"В локальном индексе нет записей старше {format_audit_key(history_from)} "
+                f"(история длиннее {AUDIT_MAX_PAGES} страниц) — результат может быть неполным."
+            )
+    else:
+        jwt_token = await token_manager.get_token()
+        if not jwt_token:
+            outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
+            return
+        audit_logs, complete = await get_audit_logs(jwt_token, user_login, count_arg)
     if audit_logs:
         if send_file:
-            # Формирование результатов в текстовом виде
-            audit_text = ""
-            for log in audit_logs:
-                audit_text += f"Логин: {log.get('audit_login', '')}\n"
-                audit_text += f"Время: {log.get('audit_datetime', '')}\n"
-                audit_text += f"IP: {log.get('audit_ip_address', '')}\n"
-                audit_text += f"Агент: {log.get('audit_agent', '')}\n"
-                audit_text += f"Результат: {log.get('audit_result', '')}\n"
-                audit_text += f"Номер токена: {log.get('audit_serialnumber', '')}\n"
-                audit_text += f"Комментарий: {log.get('audit_comments', '')}\n"
-                audit_text += "\n"
-            file_obj = io.BytesIO(audit_text.encode('utf-8'))
-            file_obj.name = f"audit_{user_login}.txt"
-            await update.message.reply_document(
-                document=InputFile(file_obj),
-                caption=f"Записи аудита для пользователя: {user_login}"
-            )
+            fmt, compress = export_format
+            filename = f"audit_{user_login}.{fmt}" + (".gz" if compress else "")
+            caption = f"Записи аудита для пользователя: {user_login}"
+            if count_arg > AUDIT_MAX_COUNT:
+                caption += f" (не больше {AUDIT_MAX_COUNT} записей)"
+            if not complete:
+                caption += "\n" + AUDIT_INCOMPLETE_NOTE
+            with spool_export(iter_audit_export(audit_logs, fmt), compress) as file_obj:
+                await outbox.reply_document(
+                    update.message,
+                    # Файл передаётся в запрос как поток, без чтения целиком в память
+                    document=InputFile(file_obj, filename=filename, read_file_handle=False),
+                    caption=caption
+                )
         else:
             response_lines = ["*Записи аудита:*"]
             for log in audit_logs:
@@ -243,91 +2425,335 @@ async def audit_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     "```"
                 )
                 response_lines.append(audit_message)
+            if not complete:
+                response_lines.append(AUDIT_INCOMPLETE_NOTE)
             response = "\n".join(response_lines)
-            await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
+            outbox.reply_text(update.message, response, parse_mode=ParseMode.MARKDOWN)
     else:
-        await update.message.reply_text("Записи аудита не найдены или произошла ошибка.")
+        outbox.reply_text(update.message, "Записи аудита не найдены или произошла ошибка.")
 
 
-async def ssh_logs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def auditstats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
-        logger.warning(f"Доступ запрещен для chat_id: {update.effective_chat.id}")
         return
-
     if not context.args:
-        logger.warning("Не указан логин пользователя")
-        await update.message.reply_text(
-            "Пожалуйста, укажите логин: `/sshlogs 'логин'`",
+        outbox.reply_text(
+            update.message,
+            "Пожалуйста, укажите логин. Пример: `/auditstats ivanova 7d`",
             parse_mode=ParseMode.MARKDOWN
         )
         return
+    user_login = context.args[0]
+    period = context.args[1] if len(context.args) > 1 else AUDITSTATS_DEFAULT_PERIOD
+    try:
+        start_key = parse_filter_time(period)
+    except ValueError as e:
+        outbox.reply_text(update.message, f"Ошибка в периоде: {e}. Укажите `30m`, `12h`, `7d` или дату `dd-mm-YYYY`.", parse_mode=ParseMode.MARKDOWN)
+        return
+    jwt_token = await token_manager.get_token()
+    if not jwt_token:
+        outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
+        return
+    since = datetime.strptime(str(start_key), "%Y%m%d%H%M%S")
+    stats = AuditStats(hourly=datetime.now() - since <= timedelta(days=AUDITSTATS_HOURLY_DAYS))
+    progress = ProgressMessage(update.message, BATCH_PROGRESS_INTERVAL)
+    pages = 0
+    try:
+        # Страницы идут от новых записей к старым и не накапливаются в памяти
+        async with contextlib.aclosing(iter_audit_pages(jwt_token, user_login, format_audit_key(start_key))) as audit_pages:
+            async for records in audit_pages:
+                pages += 1
+                keys = [audit_sort_key(record) for record in records]
+                for record, key in zip(records, keys):
+                    if key >= start_key:
+                        stats.add(record, key)
+                await progress.update(f"Обработано записей: {stats.total}...")
+                if keys and max(keys) < start_key:
+                    break
+    except SasError as e:
+        logger.error("Статистика аудита %s: %s", user_login, e)
+        outbox.reply_text(update.message, "Не удалось получить записи аудита из SAS. Попробуйте позже.")
+        return
+    finally:
+        await progress.close()
+    logger.info("Статистика аудита %s за %s: %s записей, %s страниц", user_login, period, stats.total, pages)
+    if not stats.total:
+        outbox.reply_text(update.message, f"Записей аудита за {period} не найдено.")
+        return
+    summary = stats.summary(user_login, period)
+    if pages >= AUDIT_MAX_PAGES:
+        summary += f"\nДостигнут предел {AUDIT_MAX_PAGES} страниц, более старые записи не учтены."
+    outbox.reply_text(update.message, summary, parse_mode=ParseMode.MARKDOWN)
+    with spool_export(stats.iter_series_csv()) as file_obj:
+        await outbox.reply_document(
+            update.message,
+            document=InputFile(file_obj, filename=f"auditstats_{user_login}.csv", read_file_handle=False),
+            caption=f"Ряд по {'часам' if stats.hourly else 'дням'}: записей и неудач"
+        )
 
-    user_login = context.args[0].strip("'\"")
-    logger.info(f"Запрошены логи для пользователя: {user_login}")
 
-    ssh_key_path = "/app/ssh/id_ed25519"
-    ssh_host = "10.4.96.65"
-    ssh_user = "tgbot"
+class SshChannel:
+    """Тёплое SSH-соединение с сервером логов через ControlMaster.
 
-    if not os.path.exists(ssh_key_path):
-        error_msg = f"SSH ключ не найден по пути: {ssh_key_path}"
-        logger.error(error_msg)
-        await update.message.reply_text(f"Ошибка конфигурации: {error_msg}")
-        return
+    Мастер-процесс `ssh -M -N` держит одно аутентифицированное соединение,
+    а каждая команда /sshlogs открывает поверх него отдельную сессию без
+    нового обмена ключами. Если мастер упал, фоновая задача переподключает
+    его с экспоненциальной задержкой; пока его нет, сессии подключаются
+    напрямую. Проверка ключа хоста остаётся строгой по SSH_KNOWN_HOSTS.
+    """
 
-    try:
-        safe_login = shlex.quote(user_login)
+    def __init__(self, control_path=SSH_CONTROL_PATH, max_sessions=SSH_MAX_SESSIONS):
+        self.control_path = control_path
+        self.target = f"{SSH_USER}@{SSH_HOST}"
+        self.sessions = asyncio.Semaphore(max_sessions)
+        self._master = None
+        self._task = None
 
-        ssh_command = [
-            "ssh",
-            "-i", ssh_key_path,
+    def base_args(self):
+        return [
+            SSH_COMMAND,
+            "-i", SSH_KEY_PATH,
             "-o", "StrictHostKeyChecking=yes",
-            "-o", "UserKnownHostsFile=/app/ssh/known_hosts",
+            "-o", f"UserKnownHostsFile={SSH_KNOWN_HOSTS}",
             "-o", "LogLevel=ERROR",
-            f"{ssh_user}@{ssh_host}",
-            safe_login
+            "-o", f"ControlPath={self.control_path}",
         ]
 
-        logger.debug(f"Формируемая SSH команда: {' '.join(ssh_command)}")
+    def session_args(self, remote_command):
+        # ControlMaster=no: использовать мастер, если он есть, иначе подключиться напрямую
+        return self.base_args() + ["-o", "ControlMaster=no", self.target, remote_command]
 
-        process = await asyncio.create_subprocess_exec(
-            *ssh_command,
+    async def open_session(self, remote_command):
+        args = self.session_args(remote_command)
+        logger.debug(f"Формируемая SSH команда: {' '.join(args)}")
+        return await asyncio.create_subprocess_exec(
+            *args,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE
         )
 
-        logger.info(f"Запущен SSH процесс (PID: {process.pid}) для пользователя: {user_login}")
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _supervise(self):
+        delay = 1
+        while True:
+            started = time.monotonic()
+            try:
+                await self._run_master()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка мастер-соединения SSH")
+            # Соединение прожило долго — значит, это обрыв, а не постоянный отказ
+            if time.monotonic() - started > 60:
+                delay = 1
+            logger.info("Переподключение мастер-соединения SSH через %s с.", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
 
+    async def _run_master(self):
+        # Оставшийся от прошлого запуска сокет помешал бы новому мастеру
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.control_path)
+        self._master = await asyncio.create_subprocess_exec(
+            *self.base_args(),
+            "-o", "ControlMaster=yes",
+            "-o", "ControlPersist=no",
+            "-o", "ServerAliveInterval=30",
+            "-o", "ServerAliveCountMax=3",
+            "-N", self.target,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        logger.info(f"Запущено мастер-соединение SSH (PID: {self._master.pid}) к {self.target}")
         try:
-            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=30.0)
-        except asyncio.TimeoutError:
-            logger.error(f"Таймаут SSH соединения для {user_login}")
-            await update.message.reply_text("Превышено время ожидания ответа от сервера")
+            _, stderr = await self._master.communicate()
+            logger.warning(
+                "Мастер-соединение SSH завершилось с кодом %s: %s",
+                self._master.returncode, stderr.decode(errors="replace").strip()
+            )
+        finally:
+            if self._master.returncode is None:
+                self._master.terminate()
+                with contextlib.suppress(ProcessLookupError):
+                    await self._master.wait()
+            self._master = None
+
+
+ssh_channel = SshChannel()
+
+
+class StreamingOutput:
+    """Накопитель потокового вывода SSH-команды.
+
+    Байты декодируются инкрементально, так что символ UTF-8, разрезанный
+    границей чанков, не портится. Пока текст не длиннее inline_limit, он
+    хранится в памяти для ответа сообщением; после этого весь вывод уходит
+    в сжатый gzip SpooledTemporaryFile.
+    """
+
+    def __init__(self, inline_limit=SSH_INLINE_MAX_CHARS, max_bytes=SSH_OUTPUT_MAX_BYTES):
+        self.inline_limit = inline_limit
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.lines = 0
+        self.truncated = False
+        self.spool = None
+        self._gzip = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._inline = []
+        self._inline_chars = 0
+
+    def feed(self, chunk):
+        """Добавляет чанк; возвращает False, если вывод превысил max_bytes и был обрезан."""
+        room = self.max_bytes - self.size
+        if len(chunk) > room:
+            chunk = chunk[:room]
+            self.truncated = True
+        self.size += len(chunk)
+        self.lines += chunk.count(b"\n")
+        self._write(self._decoder.decode(chunk))
+        return not self.truncated
+
+    def finish(self):
+        self._write(self._decoder.decode(b"", final=True))
+        if self._gzip is not None:
+            self._gzip.close()
+            self.spool.seek(0)
+
+    def text(self):
+        return "".join(self._inline)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+    def _write(self, text):
+        if not text:
             return
+        if self._gzip is None:
+            self._inline.append(text)
+            self._inline_chars += len(text)
+            if self._inline_chars <= self.inline_limit:
+                return
+            self.spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_SIZE)
+            self._gzip = gzip.GzipFile(fileobj=self.spool, mode="wb")
+            text = self.text()
+            self._inline = []
+        self._gzip.write(text.encode("utf-8"))
+
+
+async def ssh_logs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ALLOWED_CHAT_ID:
+        logger.warning(f"Доступ запрещен для chat_id: {update.effective_chat.id}")
+        return
+
+    if not context.args:
+        logger.warning("Не указан логин пользователя")
+        outbox.reply_text(
+            update.message,
+            "Пожалуйста, укажите логин: `/sshlogs 'логин'`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return
+
+    user_login = context.args[0].strip("'\"")
+    logger.info(f"Запрошены логи для пользователя: {user_login}")
+
+    if not os.path.exists(SSH_KEY_PATH):
+        error_msg = f"SSH ключ не найден по пути: {SSH_KEY_PATH}"
+        logger.error(error_msg)
+        outbox.reply_text(update.message, f"Ошибка конфигурации: {error_msg}")
+        return
+
+    try:
+        safe_login = shlex.quote(user_login)
+
+        async with ssh_channel.sessions:
+            process = await ssh_channel.open_session(safe_login)
+
+            logger.info(f"Запущен SSH процесс (PID: {process.pid}) для пользователя: {user_login}")
+
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            deadline = started + SSH_TIMEOUT
+            progress = ProgressMessage(update.message, SSH_PROGRESS_INTERVAL)
+            output = StreamingOutput()
+            stderr_task = asyncio.create_task(process.stderr.read())
+            try:
+                while True:
+                    chunk = await asyncio.wait_for(process.stdout.read(SSH_READ_CHUNK), timeout=deadline - loop.time())
+                    if not chunk:
+                        break
+                    if not output.feed(chunk):
+                        logger.warning(f"Вывод для {user_login} превысил {SSH_OUTPUT_MAX_BYTES} байт, чтение остановлено")
+                        with contextlib.suppress(ProcessLookupError):
+                            process.kill()
+                        break
+                    await progress.update(f"Получено строк: {output.lines} ({output.size // 1024} КБ)...")
+                await asyncio.wait_for(process.wait(), timeout=max(deadline - loop.time(), 0))
+                stderr = await stderr_task
+            except asyncio.TimeoutError:
+                logger.error(f"Таймаут SSH соединения для {user_login}")
+                metrics.error("ssh", "session", "timeout")
+                # Не оставляем зависшую сессию занимать канал
+                with contextlib.suppress(ProcessLookupError):
+                    process.kill()
+                await process.wait()
+                stderr_task.cancel()
+                output.close()
+                outbox.reply_text(update.message, "Превышено время ожидания ответа от сервера")
+                return
+            finally:
+                await progress.close()
 
         exit_code = process.returncode
         logger.debug(f"SSH процесс завершен с кодом: {exit_code}")
+        metrics.observe_latency("ssh", "session", loop.time() - started)
+        metrics.observe_size("ssh", "session", output.size)
+        if exit_code != 0 and not output.truncated:
+            metrics.error("ssh", "session", f"exit_{exit_code}")
 
-        if exit_code == 0:
-            logs = stdout.decode().strip()
-            if logs:
-                logger.info(f"Успешно получены логи для {user_login} (длина: {len(logs)} символов)")
-                if len(logs) <= 4000:
-                    await update.message.reply_text(
-                        f"<b>Логи для {user_login}:</b>\n\n<pre>{logs}</pre>",
-                        parse_mode=ParseMode.HTML
-                    )
+        # При обрезке вывода процесс завершён нами, а не с ошибкой
+        if exit_code == 0 or output.truncated:
+            output.finish()
+            try:
+                if output.spool is None:
+                    logs = output.text().strip()
+                    if logs:
+                        logger.info(f"Успешно получены логи для {user_login} (длина: {len(logs)} символов)")
+                        outbox.reply_text(
+                            update.message,
+                            f"<b>Логи для {user_login}:</b>\n\n<pre>{html.escape(logs)}</pre>",
+                            parse_mode=ParseMode.HTML
+                        )
+                    else:
+                        logger.warning(f"Пустой ответ от сервера для {user_login}")
+                        outbox.reply_text(update.message, "Сервер вернул пустой ответ")
                 else:
-                    file_obj = io.BytesIO(logs.encode('utf-8'))
-                    file_obj.name = f"logs_{user_login}.txt"
-                    await update.message.reply_document(
-                        document=InputFile(file_obj),
-                        caption=f"Логи для {user_login} (вложением, т.к. длинные)"
+                    logger.info(f"Успешно получены логи для {user_login} (размер: {output.size} байт, строк: {output.lines})")
+                    caption = f"Логи для {user_login} (вложением, т.к. длинные)"
+                    if output.truncated:
+                        caption += f", обрезаны до {SSH_OUTPUT_MAX_BYTES // 1024} КБ"
+                    await outbox.reply_document(
+                        update.message,
+                        document=InputFile(output.spool, filename=f"logs_{user_login}.txt.gz", read_file_handle=False),
+                        caption=caption
                     )
-            else:
-                logger.warning(f"Пустой ответ от сервера для {user_login}")
-                await update.message.reply_text("Сервер вернул пустой ответ")
+            finally:
+                output.close()
         else:
+            output.close()
             error_msg = stderr.decode().strip()
             logger.error(f"SSH ошибка (код {exit_code}): {error_msg}")
 
@@ -336,14 +2762,14 @@ async def ssh_logs_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             elif "Connection timed out" in error_msg:
                 error_msg = "Таймаут соединения с сервером"
 
-            await update.message.reply_text(f"Ошибка SSH:\n{error_msg}")
+            outbox.reply_text(update.message, f"Ошибка SSH:\n{error_msg}")
 
     except FileNotFoundError as e:
         logger.error(f"Не найден SSH клиент: {str(e)}")
-        await update.message.reply_text("Ошибка: SSH клиент не установлен в системе")
+        outbox.reply_text(update.message, "Ошибка: SSH клиент не установлен в системе")
     except Exception as e:
         logger.exception(f"Неожиданная ошибка при обработке запроса для {user_login}")
-        await update.message.reply_text(f"Произошла непредвиденная ошибка: {str(e)}")
+        outbox.reply_text(update.message, f"Произошла непредвиденная ошибка: {str(e)}")
 
 
 def generate_login_variants(login: str) -> list:
@@ -360,28 +2786,122 @@ def generate_login_variants(login: str) -> list:
     return list({variant1, variant2})
 
 
-def get_enrollment_tasks_universal(token, user_login):
-    variants = generate_login_variants(user_login)
-    logger.info("Генерируем варианты логина для '%s': %s", user_login, variants)
+class LoginVariantCache:
+    """Запоминает, в каком регистре SAS принял логин, и какие варианты отклонил.
+
+    Отклонённые варианты не запрашиваются LOGIN_VARIANT_NEGATIVE_TTL секунд.
+    Оба словаря ограничены max_size: принятые логины вытесняются по LRU,
+    отклонённые — по времени истечения (TTL у всех одинаковый, поэтому
+    порядок вставки совпадает с порядком истечения).
+    """
+
+    def __init__(self, negative_ttl=LOGIN_VARIANT_NEGATIVE_TTL, max_size=LOGIN_VARIANT_MAX_SIZE):
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._accepted = OrderedDict()
+        self._rejected = OrderedDict()
+
+    def resolved(self, login):
+        key = login.strip().lower()
+        variants = self._accepted.get(key)
+        if variants is not None:
+            self._accepted.move_to_end(key)
+        return variants
+
+    def candidates(self, login):
+        variants = generate_login_variants(login)
+        now = time.time()
+        self._prune(now)
+        fresh = [v for v in variants if self._rejected.get(v, 0) <= now]
+        # Если отклонены все варианты, пробуем их снова
+        return fresh or variants
+
+    def accept(self, login, variants):
+        key = login.strip().lower()
+        self._accepted[key] = tuple(variants)
+        self._accepted.move_to_end(key)
+        while len(self._accepted) > self.max_size:
+            self._accepted.popitem(last=False)
+        for variant in variants:
+            self._rejected.pop(variant, None)
+
+    def reject(self, variant):
+        self._rejected.pop(variant, None)
+        self._rejected[variant] = time.time() + self.negative_ttl
+        while len(self._rejected) > self.max_size:
+            self._rejected.popitem(last=False)
+
+    def _prune(self, now):
+        while self._rejected:
+            variant, expires_at = next(iter(self._rejected.items()))
+            if expires_at > now:
+                break
+            del self._rejected[variant]
+
+    def forget(self, login):
+        self._accepted.pop(login.strip().lower(), None)
+
+
+login_variants = LoginVariantCache()
+
+
+async def fetch_enrollments_for_variant(token, variant):
+    """Задачи активации для одного варианта логина: (задачи, ошибка, SAS отклонил логин)."""
+    data = {"org_name": ORG_NAME, "user_login": variant}
+    try:
+        resp = await sas_get("/sdk/users/enrollments", token, data)
+        logger.info("Запрос для логина '%s': HTTP %s, ответ: %s", variant, resp.status_code, resp.text)
+        if resp.status_code == 200:
+            body = resp.json()
+            if body.get("Result") == 0:
+                return body.get("Data", []), None, False
+            return [], f"Логин '{variant}': {body.get('Details', 'Нет описания')}", True
+        return [], f"Логин '{variant}': HTTP {resp.status_code}: {resp.text}", False
+    except httpx.HTTPError as e:
+        return [], f"Логин '{variant}': Сетевая ошибка: {str(e)}", False
+
+
+async def get_enrollment_tasks_universal(token, user_login):
+    return await response_cache.get_or_load(
+        "/sdk/users/enrollments", user_login, (),
+        lambda: fetch_enrollment_tasks(token, user_login),
+        cacheable=lambda value: not value[1],
+    )
+
+
+async def fetch_enrollment_tasks(token, user_login):
     all_tasks = []
     errors = []
-    for variant in variants:
-        url = f"{BASE_URL}/sdk/users/enrollments"
-        headers = {"Authorization": token, "Content-Type": "application/json"}
-        data = {"org_name": ORG_NAME, "user_login": variant}
-        try:
-            resp = requests.get(url, headers=headers, data=json.dumps(data), timeout=10, verify=False)
-            logger.info("Запрос для логина '%s': HTTP %s, ответ: %s", variant, resp.status_code, resp.text)
-            if resp.status_code == 200:
-                body = resp.json()
-                if body.get("Result") == 0:
-                    all_tasks.extend(body.get("Data", []))
-                else:
-                    errors.append(f"Логин '{variant}': {body.get('Details', 'Нет описания')}")
-            else:
-                errors.append(f"Логин '{variant}': HTTP {resp.status_code}: {resp.text}")
-        except requests.exceptions.RequestException as e:
-            errors.append(f"Логин '{variant}': Сетевая ошибка: {str(e)}")
+    resolved = login_variants.resolved(user_login)
+    if resolved:
+        # Регистр логина уже известен — достаточно одного запроса на вариант
+        results = await asyncio.gather(*(fetch_enrollments_for_variant(token, v) for v in resolved))
+        if all(error is None for _, error, _ in results):
+            for tasks, _, _ in results:
+                all_tasks.extend(tasks)
+            unique_tasks = {task.get("enrollment_id"): task for task in all_tasks}.values()
+            return list(unique_tasks), errors
+        logger.info("Сохранённые варианты логина '%s' %s больше не подходят, проверяю все.", user_login, resolved)
+        login_variants.forget(user_login)
+    variants = login_variants.candidates(user_login)
+    logger.info("Генерируем варианты логина для '%s': %s", user_login, variants)
+    results = await asyncio.gather(*(fetch_enrollments_for_variant(token, v) for v in variants))
+    accepted = []
+    rejections = []
+    for variant, (tasks, error, rejected) in zip(variants, results):
+        if error is None:
+            all_tasks.extend(tasks)
+            accepted.append(variant)
+        elif rejected:
+            # Отклонённый регистр — обычное дело, он уходит только в негативный кеш
+            rejections.append(error)
+            login_variants.reject(variant)
+        else:
+            errors.append(error)
+    if accepted:
+        login_variants.accept(user_login, accepted)
+    else:
+        errors.extend(rejections)
     # Убираем дубли по enrollment_id
     unique_tasks = {task.get("enrollment_id"): task for task in all_tasks}.values()
     return list(unique_tasks), errors
@@ -389,18 +2909,21 @@ def get_enrollment_tasks_universal(token, user_login):
 async def enrollments_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
         return
+    if is_batch_request(update, context.args or []):
+        await run_batch(update, "Задачи активации", "enrollments", context.args or [], batch_enrollments)
+        return
     if not context.args:
-        await update.message.reply_text("Пожалуйста, укажите логин. Пример: `/enrollments ivanova`", parse_mode=ParseMode.MARKDOWN)
+        outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/enrollments ivanova`", parse_mode=ParseMode.MARKDOWN)
         return
     user_login = context.args[0]
-    jwt_token = get_jwt_token()
+    jwt_token = await token_manager.get_token()
     if not jwt_token:
-        await update.message.reply_text("Ошибка авторизации. Попробуйте позже.")
+        outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
         return
-    enrollment_tasks, errors = get_enrollment_tasks_universal(jwt_token, user_login)
+    enrollment_tasks, errors = await get_enrollment_tasks_universal(jwt_token, user_login)
     if errors:
         error_text = "\n".join(errors)
-        await update.message.reply_text(f"Ошибка при получении задач активации:\n{error_text}", parse_mode=ParseMode.MARKDOWN)
+        outbox.reply_text(update.message, f"Ошибка при получении задач активации:\n{error_text}", parse_mode=ParseMode.MARKDOWN)
     else:
         if enrollment_tasks:
             response_lines = ["*Список задач активации:*"]
@@ -416,72 +2939,283 @@ async def enrollments_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
                 )
                 response_lines.append(task_message)
             response = "\n".join(response_lines)
-            await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN)
+            outbox.reply_text(update.message, response, parse_mode=ParseMode.MARKDOWN)
         else:
-            await update.message.reply_text("У пользователя отсутствуют задачи активации.", parse_mode=ParseMode.MARKDOWN)
+            outbox.reply_text(update.message, "У пользователя отсутствуют задачи активации.", parse_mode=ParseMode.MARKDOWN)
 
 
 async def active_link_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != ALLOWED_CHAT_ID:
         return
     if not context.args:
-        await update.message.reply_text("Пожалуйста, укажите логин. Пример: `/activelink ivanova`", parse_mode=ParseMode.MARKDOWN)
+        outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/activelink ivanova`", parse_mode=ParseMode.MARKDOWN)
         return
     user_login = context.args[0]
-    jwt_token = get_jwt_token()
+    jwt_token = await token_manager.get_token()
     if not jwt_token:
-        await update.message.reply_text("Ошибка авторизации. Попробуйте позже.")
+        outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
         return
-    enrollment_tasks, errors = get_enrollment_tasks_universal(jwt_token, user_login)
+    enrollment_tasks, errors = await get_enrollment_tasks_universal(jwt_token, user_login)
     if errors:
         error_text = "\n".join(errors)
-        await update.message.reply_text(f"Ошибка при получении задач:\n{error_text}", parse_mode=ParseMode.MARKDOWN)
+        outbox.reply_text(update.message, f"Ошибка при получении задач:\n{error_text}", parse_mode=ParseMode.MARKDOWN)
     else:
         links = [t.get("enrollment_url") for t in enrollment_tasks if t.get("enrollment_url")]
         if links:
             link_text = "*Ссылки на задачи активации:*\n\n"
             link_text += "\n".join([f"{i+1}. {link}" for i, link in enumerate(links)])
-            await update.message.reply_text(link_text, parse_mode=ParseMode.MARKDOWN)
+            outbox.reply_text(update.message, link_text, parse_mode=ParseMode.MARKDOWN)
+        else:
+            outbox.reply_text(update.message, "Активных ссылок на задачи не найдено.", parse_mode=ParseMode.MARKDOWN)
+
+
+async def document_command_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда в подписи к файлу со списком логинов: `/tokens`, `/enrollments` или `/audit [количество]`."""
+    parts = (update.message.caption or "").split()
+    command = parts[0][1:].split("@")[0].lower() if parts else ""
+    handler = {
+        "tokens": tokens_handler,
+        "enrollments": enrollments_handler,
+        "audit": audit_handler,
+    }.get(command)
+    if handler is None:
+        return
+    context.args = parts[1:]
+    await handler(update, context)
+
+
+async def watch_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ALLOWED_CHAT_ID:
+        return
+    chat_id = update.effective_chat.id
+    if not context.args:
+        watched = [login for _, login, _ in audit_store.watches(chat_id)]
+        if watched:
+            outbox.reply_text(update.message, "Наблюдение за аудитом: " + ", ".join(watched))
         else:
-            await update.message.reply_text("Активных ссылок на задачи не найдено.", parse_mode=ParseMode.MARKDOWN)
+            outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/watch ivanova`", parse_mode=ParseMode.MARKDOWN)
+        return
+    jwt_token = await token_manager.get_token()
+    if not jwt_token:
+        outbox.reply_text(update.message, "Ошибка авторизации. Попробуйте позже.")
+        return
+    for user_login in context.args:
+        # Начальная синхронизация: история до подписки считается известной
+        try:
+            await audit_store.sync(jwt_token, user_login)
+        except SasError as e:
+            logger.error("Не удалось синхронизировать аудит %s для наблюдения: %s", user_login, e)
+            outbox.reply_text(update.message, f"Не удалось получить аудит {user_login}, наблюдение не включено.")
+            continue
+        if audit_store.add_watch(chat_id, user_login):
+            logger.info("Включено наблюдение за аудитом %s в чате %s", user_login, chat_id)
+            outbox.reply_text(
+                update.message,
+                f"Наблюдение за {user_login} включено: сообщу о неудачных входах и входах с новых IP."
+            )
+        else:
+            outbox.reply_text(update.message, f"Наблюдение за {user_login} уже включено.")
+
+
+async def unwatch_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ALLOWED_CHAT_ID:
+        return
+    if not context.args:
+        outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/unwatch ivanova`", parse_mode=ParseMode.MARKDOWN)
+        return
+    for user_login in context.args:
+        if audit_store.remove_watch(update.effective_chat.id, user_login):
+            logger.info("Выключено наблюдение за аудитом %s в чате %s", user_login, update.effective_chat.id)
+            outbox.reply_text(update.message, f"Наблюдение за {user_login} выключено.")
+        else:
+            outbox.reply_text(update.message, f"Наблюдение за {user_login} не было включено.")
+
+
+async def refresh_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ALLOWED_CHAT_ID:
+        return
+    if not context.args:
+        outbox.reply_text(update.message, "Пожалуйста, укажите логин. Пример: `/refresh ivanova`", parse_mode=ParseMode.MARKDOWN)
+        return
+    user_login = context.args[0]
+    removed = response_cache.invalidate_login(user_login)
+    login_variants.forget(user_login)
+    logger.info("Кеш для %s сброшен (записей: %s). Статистика кеша: %s", user_login, removed, response_cache.stats())
+    outbox.reply_text(update.message, f"Кеш для пользователя {user_login} сброшен (записей: {removed}).")
+
+
+async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ALLOWED_CHAT_ID:
+        return
+    cancelled = scheduler.cancel(update.effective_user.id)
+    if cancelled:
+        outbox.reply_text(update.message, f"Отменено команд в очереди: {cancelled}.")
+    else:
+        outbox.reply_text(update.message, "Нет команд в очереди.")
+
+
+async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_chat.id != ALLOWED_CHAT_ID:
+        return
+    lines = [metrics.render_text(), "", "Кеш ответов SAS (попадания / промахи / объединённые):"]
+    for endpoint, counters in response_cache.stats().items():
+        lines.append(f"{endpoint}: {counters['hits']} / {counters['misses']} / {counters['coalesced']}")
+    lines.extend(["", "Планировщик (выполняется / в очереди):"])
+    for name, (running, waiting) in scheduler.stats().items():
+        lines.append(f"{name}: {running} / {waiting}")
+    lines.extend(["", f"Circuit breaker SAS: {sas_client.breaker.state}", "Таймауты SAS, с:"])
+    for path in SAS_TIMEOUTS:
+        lines.append(f"{path}: {sas_client.timeouts.timeout(path):.1f}")
+    outbox.reply_text(
+        update.message,
+        f"<b>Статистика:</b>\n\n<pre>{html.escape(chr(10).join(lines))}</pre>",
+        parse_mode=ParseMode.HTML
+    )
 
 
 async def get_chat_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     #if update.effective_chat.id != ALLOWED_CHAT_ID:
     #    return
     chat_id = update.effective_chat.id
-    await update.message.reply_text(f"Chat ID: {chat_id}")
+    outbox.reply_text(update.message, f"Chat ID: {chat_id}")
 
 
-async def main():
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+metrics_server = None
 
-    # Список команд с описаниями для подсказок
-    commands = [
-        ("start", "Начальное сообщение"),
-        ("help", "Показать справку"),
-        ("tokens", "Получить токены пользователя"),
-        ("audit", "Получить записи аудита"),
-        ("enrollments", "Задачи активации"),
-        ("getchatid", "Узнать ID чата"),
-        ("activelink", "Ссылки на активации"),
-        ("sshlogs", "Получить логи через SSH")
-    ]
+# Список команд с описаниями для подсказок
+BOT_COMMANDS = [
+    ("start", "Начальное сообщение"),
+    ("help", "Показать справку"),
+    ("tokens", "Получить токены пользователя"),
+    ("audit", "Получить записи аудита"),
+    ("enrollments", "Задачи активации"),
+    ("getchatid", "Узнать ID чата"),
+    ("activelink", "Ссылки на активации"),
+    ("sshlogs", "Получить логи через SSH"),
+    ("refresh", "Сбросить кеш пользователя"),
+    ("auditstats", "Статистика аудита за период"),
+    ("watch", "Следить за аудитом пользователя"),
+    ("unwatch", "Перестать следить за аудитом"),
+    ("cancel", "Отменить свои команды в очереди"),
+    ("stats", "Статистика задержек и ошибок")
+]
 
+
+async def on_startup(app):
+    global metrics_server
     # Устанавливаем команды для отображения в подсказках
-    await app.bot.set_my_commands(commands)
-
-    # Регистрируем обработчики
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_handler))
-    app.add_handler(CommandHandler("tokens", tokens_handler))
-    app.add_handler(CommandHandler("audit", audit_handler))
-    app.add_handler(CommandHandler("getchatid", get_chat_id))
-    app.add_handler(CommandHandler("enrollments", enrollments_handler))
-    app.add_handler(CommandHandler("activelink", active_link_handler))
-    app.add_handler(CommandHandler("sshlogs", ssh_logs_handler))
-    logger.info("Бот запущен.")
-    await app.run_polling()
+    await app.bot.set_my_commands(BOT_COMMANDS)
+    if SSH_MULTIPLEX and os.path.exists(SSH_KEY_PATH):
+        ssh_channel.start()
+    if WATCH_ENABLED:
+        audit_watcher.start(app.bot)
+    else:
+        logger.info("Фоновый опрос /watch отключён (WATCH_ENABLED=0)")
+    if METRICS_PORT:
+        metrics_server = await serve_http(METRICS_HOST, METRICS_PORT, handle_metrics_request)
+        logger.info("Метрики Prometheus доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+
+async def on_stop(app):
+    # Бот ещё может отправлять: досылаем то, что осталось в очередях чатов
+    await audit_watcher.stop()
+    await outbox.drain()
+
+
+async def on_shutdown(app):
+    logger.info("Статистика кеша ответов SAS: %s", response_cache.stats())
+    audit_store.close()
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    await ssh_channel.stop()
+    await sas_client.aclose()
+
+
+def build_application():
+    # concurrent_updates: медленный ответ SAS в одном чате не задерживает остальные команды
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(True)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # Регистрируем обработчики. Команды, которые ходят в SAS или по SSH,
+    # проходят через планировщик: тяжёлые и лёгкие — в разных пулах
+    app.add_handler(CommandHandler("start", instrumented("start", start)))
+    app.add_handler(CommandHandler("help", instrumented("help", help_handler)))
+    app.add_handler(CommandHandler("tokens", instrumented("tokens", scheduler.wrap(tokens_handler, batch_pool))))
+    app.add_handler(CommandHandler("audit", instrumented("audit", scheduler.wrap(audit_handler, audit_pool))))
+    app.add_handler(CommandHandler("getchatid", instrumented("getchatid", get_chat_id)))
+    app.add_handler(CommandHandler("enrollments", instrumented("enrollments", scheduler.wrap(enrollments_handler, batch_pool))))
+    app.add_handler(CommandHandler("activelink", instrumented("activelink", scheduler.wrap(active_link_handler, "light"))))
+    app.add_handler(CommandHandler("sshlogs", instrumented("sshlogs", scheduler.wrap(ssh_logs_handler, "heavy"))))
+    app.add_handler(CommandHandler("refresh", instrumented("refresh", refresh_handler)))
+    app.add_handler(CommandHandler("stats", instrumented("stats", stats_handler)))
+    app.add_handler(CommandHandler("auditstats", instrumented("auditstats", scheduler.wrap(auditstats_handler, "heavy"))))
+    app.add_handler(CommandHandler("watch", instrumented("watch", scheduler.wrap(watch_handler, "heavy"))))
+    app.add_handler(CommandHandler("unwatch", instrumented("unwatch", unwatch_handler)))
+    app.add_handler(CommandHandler("cancel", instrumented("cancel", cancel_handler)))
+    app.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r"^/(tokens|enrollments|audit)(@\w+)?(\s|$)"),
+        instrumented("document", scheduler.wrap(document_command_handler, "heavy"))
+    ))
+    return app
+
+
+async def run_webhook(app):
+    """Режим webhook: обновления принимает встроенный HTTP-сервер до SIGINT/SIGTERM.
+
+    Хуки post_init/post_stop/post_shutdown вызываются здесь вручную — их
+    вызывает только run_polling. При остановке сервер сначала перестаёт
+    принимать обновления, затем приложение дорабатывает уже принятые.
+    Повторный setWebhook с тем же URL безопасен, поэтому несколько
+    экземпляров за обратным прокси запускаются одинаково.
+    """
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise SystemExit("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    server = None
+    await app.initialize()
+    try:
+        await on_startup(app)
+        await app.bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        await app.start()
+        server = await serve_http(WEBHOOK_HOST, WEBHOOK_PORT, webhook_handler(app))
+        logger.info("Бот запущен в режиме webhook на %s:%s%s.", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+        await stop.wait()
+        logger.info("Получен сигнал остановки, завершаю работу.")
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+        if app.running:
+            await app.stop()
+            await on_stop(app)
+        await app.shutdown()
+        await on_shutdown(app)
+
+
+def main():
+    app = build_application()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        logger.info("Бот запущен.")
+        app.run_polling()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
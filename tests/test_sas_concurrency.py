@@ -0,0 +1,70 @@
+"""Параллельные запросы к SAS не выстраиваются в очередь.
+
+Запуск из корня проекта:
+
+    python -m pytest -q tests
+"""
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+LATENCY = 0.3
+CONCURRENT = 10
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+PORT = free_port()
+os.environ.update({
+    "BASE_URL": f"http://127.0.0.1:{PORT}",
+    "N": "5",
+    "ORG_NAME": "test",
+    "CACHE_TTL_TOKENS": "0",
+    "SAS_MAX_CONNECTIONS": str(CONCURRENT),
+    "AUDIT_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bot_test_"), "audit.db"),
+})
+
+import main  # noqa: E402
+from mock_sas import MockSas  # noqa: E402
+
+
+class ConcurrentSasCallsTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.mock = MockSas(latency=LATENCY)
+        self.server = await self.mock.start("127.0.0.1", PORT)
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await main.sas_client.aclose()
+
+    async def test_concurrent_lookups_take_about_one_latency(self):
+        token = await main.token_manager.get_token()
+        self.assertTrue(token)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(main.get_tokens_for_user(token, f"user{i}", main.N) for i in range(CONCURRENT))
+        )
+        elapsed = time.perf_counter() - started
+
+        self.assertTrue(all(results))
+        self.assertEqual(self.mock.requests["/sdk/users/user-tokens"], CONCURRENT)
+        # Последовательно вышло бы CONCURRENT * LATENCY = 3 с
+        self.assertLess(elapsed, LATENCY * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
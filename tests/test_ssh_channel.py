@@ -0,0 +1,126 @@
+"""SshChannel с поддельным SSH_COMMAND: аргументы мастера и сессий,
+строгая проверка ключа хоста, параллельные сессии и перезапуск мастера.
+
+Поддельный ssh записывает свои аргументы в журнал; мастер (`-N`) живёт
+FAKE_SSH_MASTER_LIFETIME секунд, сессия печатает строку через
+FAKE_SSH_DELAY секунд.
+"""
+import asyncio
+import json
+import os
+import stat
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for name, value in (("N", "5"), ("ORG_NAME", "test"), ("BASE_URL", "http://127.0.0.1:9")):
+    os.environ.setdefault(name, value)
+os.environ.setdefault("AUDIT_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bot_test_"), "audit.db"))
+
+import main  # noqa: E402
+
+FAKE_SSH = """#!{python}
+import json, os, sys, time
+with open(os.environ["FAKE_SSH_LOG"], "a") as log:
+    log.write(json.dumps(sys.argv[1:]) + "\\n")
+if "-N" in sys.argv:
+    time.sleep(float(os.environ["FAKE_SSH_MASTER_LIFETIME"]))
+else:
+    time.sleep(float(os.environ["FAKE_SSH_DELAY"]))
+    print("log line for", sys.argv[-1])
+"""
+
+DELAY = 0.3
+
+
+def option(args, name):
+    """Значение `-o name=value` из аргументов ssh."""
+    values = [arg.split("=", 1)[1] for flag, arg in zip(args, args[1:]) if flag == "-o" and arg.startswith(name + "=")]
+    return values[-1] if values else None
+
+
+class SshChannelTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="bot_ssh_")
+        fake_ssh = os.path.join(self.workdir, "ssh")
+        with open(fake_ssh, "w") as f:
+            f.write(FAKE_SSH.format(python=sys.executable))
+        os.chmod(fake_ssh, os.stat(fake_ssh).st_mode | stat.S_IEXEC)
+        self.log = os.path.join(self.workdir, "calls.jsonl")
+        self.known_hosts = os.path.join(self.workdir, "known_hosts")
+        patches = [
+            mock.patch.object(main, "SSH_COMMAND", fake_ssh),
+            mock.patch.object(main, "SSH_KEY_PATH", os.path.join(self.workdir, "id_ed25519")),
+            mock.patch.object(main, "SSH_KNOWN_HOSTS", self.known_hosts),
+            mock.patch.dict(os.environ, {
+                "FAKE_SSH_LOG": self.log,
+                "FAKE_SSH_DELAY": str(DELAY),
+                "FAKE_SSH_MASTER_LIFETIME": "0.2",
+            }),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.channel = main.SshChannel(control_path=os.path.join(self.workdir, "ctl.sock"), max_sessions=2)
+
+    async def asyncTearDown(self):
+        await self.channel.stop()
+
+    def calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as f:
+            return [json.loads(line) for line in f]
+
+    def assert_strict(self, args):
+        self.assertEqual(option(args, "StrictHostKeyChecking"), "yes")
+        self.assertEqual(option(args, "UserKnownHostsFile"), self.known_hosts)
+        self.assertEqual(option(args, "ControlPath"), self.channel.control_path)
+
+    async def test_session_arguments(self):
+        process = await self.channel.open_session("ivanova")
+        stdout, _ = await process.communicate()
+        self.assertEqual(stdout.decode().strip(), "log line for ivanova")
+        [args] = self.calls()
+        self.assert_strict(args)
+        self.assertEqual(option(args, "ControlMaster"), "no")
+        self.assertEqual(args[-2:], [self.channel.target, "ivanova"])
+        self.assertNotIn("-N", args)
+
+    async def test_sessions_run_concurrently_up_to_the_limit(self):
+        async def session(login):
+            async with self.channel.sessions:
+                process = await self.channel.open_session(login)
+                await process.communicate()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(session(f"user{i}") for i in range(4)))
+        elapsed = time.perf_counter() - started
+        self.assertEqual(len(self.calls()), 4)
+        # max_sessions=2: две волны по DELAY, а не четыре подряд
+        self.assertGreaterEqual(elapsed, DELAY * 2)
+        self.assertLess(elapsed, DELAY * 4)
+
+    async def test_master_arguments_and_restart(self):
+        self.channel.start()
+        deadline = time.monotonic() + 5
+        while len(self.calls()) < 2 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        masters = self.calls()
+        # Мастер прожил 0.2 с и был перезапущен после задержки
+        self.assertGreaterEqual(len(masters), 2)
+        for args in masters:
+            self.assert_strict(args)
+            self.assertEqual(option(args, "ControlMaster"), "yes")
+            self.assertEqual(option(args, "ControlPersist"), "no")
+            self.assertEqual(args[-2:], ["-N", self.channel.target])
+        await self.channel.stop()
+        self.assertIsNone(self.channel._master)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+"""webhook_handler через serve_http без Telegram: заглушка приложения
+вместо Application, обновления отправляются на локальный порт.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for name, value in (("N", "5"), ("ORG_NAME", "test"), ("BASE_URL", "http://127.0.0.1:9")):
+    os.environ.setdefault(name, value)
+os.environ.setdefault("AUDIT_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bot_test_"), "audit.db"))
+
+import main  # noqa: E402
+
+SECRET = "test-secret"
+
+# Обновление в том виде, в каком его присылает Telegram
+RECORDED_UPDATE = {
+    "update_id": 100,
+    "message": {
+        "message_id": 7,
+        "date": 1735689600,
+        "chat": {"id": -1002321217341, "type": "supergroup", "title": "audit"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Ivan"},
+        "text": "/tokens ivanova",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 7}],
+    },
+}
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        patch = mock.patch.object(main, "WEBHOOK_SECRET", SECRET)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.app = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        self.server = await main.serve_http("127.0.0.1", 0, main.webhook_handler(self.app))
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}"
+        self.client = httpx.AsyncClient()
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def post(self, body, secret=SECRET):
+        return await self.client.post(
+            self.url, content=body, headers={"X-Telegram-Bot-Api-Secret-Token": secret}
+        )
+
+    async def test_wrong_secret_is_forbidden(self):
+        resp = await self.post(json.dumps(RECORDED_UPDATE), secret="wrong")
+        self.assertEqual(resp.status_code, 403)
+        self.assertTrue(self.app.update_queue.empty())
+
+    async def test_body_that_is_not_an_update_is_rejected(self):
+        for body in ("not json", "[1, 2]", "null", '{"foo": 1}'):
+            with self.subTest(body=body):
+                resp = await self.post(body)
+                self.assertEqual(resp.status_code, 400)
+        self.assertTrue(self.app.update_queue.empty())
+
+    async def test_recorded_update_is_queued(self):
+        resp = await self.post(json.dumps(RECORDED_UPDATE))
+        self.assertEqual(resp.status_code, 200)
+        update = self.app.update_queue.get_nowait()
+        self.assertEqual(update.update_id, 100)
+        self.assertEqual(update.message.text, "/tokens ivanova")
+
+    async def test_healthz(self):
+        resp = await self.client.get(self.url.rsplit("/", 1)[0] + "/healthz")
+        self.assertEqual((resp.status_code, resp.text), (200, "ok"))
+
+
+if __name__ == "__main__":
+    unittest.main()